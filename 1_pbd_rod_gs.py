@@ -1,14 +1,24 @@
 import taichi as ti
-ti.init(arch=ti.cpu)
-
-n = 5
-pos = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
-old_pos = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
+from headless import parse_args, run_headless, edge_residual, real_type
+from controller import IterationController
+from residual_log import ResidualRecorder
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+
+args = parse_args(n=5, h=0.01, max_ite=10, solvers=("gs",), arch="cpu",
+                  control=True)
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+
+n = args.n
+pos = ti.Vector.field(n=2, dtype=real, shape=n)
+old_pos = ti.Vector.field(n=2, dtype=real, shape=n)
 edge = ti.Vector.field(n=2, dtype=ti.i32, shape=n - 1)
-rest_len = ti.field(dtype=ti.f32, shape=n - 1)
-inv_mass = ti.field(dtype=ti.f32, shape=n)
-vel = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
-h, MaxIte = 0.01, 10  # time step size: 10ms, Maximu iteration number
+rest_len = ti.field(dtype=real, shape=n - 1)
+inv_mass = ti.field(dtype=real, shape=n)
+vel = ti.Vector.field(n=2, dtype=real, shape=n)
+h, MaxIte = args.h, args.max_ite  # time step size: 10ms, Maximu iteration number
 pause = True
 
 
@@ -31,7 +41,7 @@ def init_constrint():
 
 
 @ti.kernel
-def seme_euler(h: ti.f32):
+def seme_euler(h: real):
     gravity = ti.Vector([0.0, -9.8])
     for i in range(n):
         if inv_mass[i] != 0.0:
@@ -41,37 +51,68 @@ def seme_euler(h: ti.f32):
 
 
 @ti.kernel
-def solve_constraints():
+def solve_constraints() -> real:
+    # dual residual: every edge's constraint right before its projection
+    dual_residual = 0.0
     for i in range(n - 1):
         idx0, idx1 = edge[i]
         invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
         dis = pos[idx0] - pos[idx1]
         constraint = dis.norm() - rest_len[i]
+        dual_residual += constraint**2
         gradient = dis.normalized()
         l = -constraint / (invM0 + invM1)
         if invM0 != 0.0:
             pos[idx0] += invM0 * l * gradient
         if invM1 != 0.0:
             pos[idx1] -= invM1 * l * gradient
+    return dual_residual
 
 
 @ti.kernel
-def update_vel(h: ti.f32):
+def update_vel(h: real):
     for i in range(n):
         if inv_mass[i] != 0.0:
             vel[i] = (pos[i] - old_pos[i]) / h
 
 
 def update(h):
+    recorder.new_frame()
     seme_euler(h)
+    control.new_frame()
     for i in range(MaxIte):
-        solve_constraints()
+        dual_residual = solve_constraints()
+        recorder.record(i, dual_residual)
+        if control.done(i, dual_residual):
+            break
+    control.end_frame()
     update_vel(h)
 
 
-gui = ti.GUI("Display Rod", res=(500, 500))
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h)
+    return control.total - total
+
+
+recorder = ResidualRecorder(args.residual_log or "data/Rod_GS.bin",
+                            args.solver, squared=True)
+control = IterationController.from_args(args, squared=True)
+cache.prewarm(globals())
 init_pos()
 init_constrint()
+state = dict(pos=pos, old_pos=old_pos, vel=vel, inv_mass=inv_mass,
+             rest_len=rest_len, edge=edge)
+restore(args, state)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(pos, edge, rest_len),
+                 stats=[control.stats, cache.stats], reset=control.reset,
+                 n=n)
+    checkpoint(args, state)
+    raise SystemExit
+
+gui = ti.GUI("Display Rod", res=(500, 500))
 while gui.running:
 
     gui.get_event(ti.GUI.PRESS)
@@ -89,3 +130,4 @@ while gui.running:
     gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
     gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
     gui.show()
+checkpoint(args, state)
@@ -1,21 +1,85 @@
 """
 Jacobi solver
 """
+import math
+
+import numpy as np
 import taichi as ti
+from headless import (make_parser, run_headless, edge_residual, real_type,
+                      real_numpy_type)
+from residual_log import ResidualRecorder, DeviceResidualHistory
+from chebyshev import ChebyshevAccelerator
+from controller import IterationController
+from profiling import Profiler
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
 
-ti.init(arch=ti.gpu)
+parser = make_parser(__doc__, n=10, h=0.01, max_ite=100,
+                     solvers=("jacobi", "chebyshev", "anderson"), arch="gpu",
+                     history=True, fuse=True, control=True, profile=True,
+                     xpbd=True, precision=("f32", "f64", "mixed"))
+parser.add_argument("--rho", type=float,
+                    help="fixed spectral radius (default: estimated online)")
+parser.add_argument("--cheb-warmup", type=int, default=10,
+                    help="plain Jacobi iterations before the acceleration")
+parser.add_argument("--anderson-m", type=int, default=5,
+                    help="Anderson history window")
+args = parser.parse_args()
+if args.solver == "anderson" and args.fuse != "none":
+    parser.error("--solver anderson mixes on the host, use --fuse none")
+if args.compliance is not None and args.solver != "jacobi":
+    parser.error("--compliance accumulates multipliers, use --solver jacobi")
+if args.precision == "mixed" and (args.solver != "jacobi" or args.fuse != "none"):
+    parser.error("--precision mixed runs --solver jacobi with --fuse none")
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+profiler = Profiler.from_args(args)
 
-n = 10
-pos = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
-old_pos = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
+n = args.n
+pos = ti.Vector.field(n=2, dtype=real, shape=n)
+old_pos = ti.Vector.field(n=2, dtype=real, shape=n)
 edge = ti.Vector.field(n=2, dtype=ti.i32, shape=n - 1)
-rest_len = ti.field(dtype=ti.f32, shape=n - 1)
-inv_mass = ti.field(dtype=ti.f32, shape=n)
-vel = ti.Vector.field(n=2, dtype=ti.f32, shape=n)
-h, MaxIte = 0.01, 100  # time step size: 10ms, Maximu iteration number
+rest_len = ti.field(dtype=real, shape=n - 1)
+inv_mass = ti.field(dtype=real, shape=n)
+vel = ti.Vector.field(n=2, dtype=real, shape=n)
+h, MaxIte = args.h, args.max_ite  # time step size: 10ms, Maximu iteration number
 pause = True
-gradient = ti.Vector.field(n=2, dtype=ti.f32, shape=n - 1)
-constraint = ti.field(ti.f32, shape=n - 1)
+gradient = ti.Vector.field(n=2, dtype=real, shape=n - 1)
+constraint = ti.field(real, shape=n - 1)
+# XPBD, see --compliance: compliance / h^2 and accumulated multiplier per edge
+xpbd = args.compliance is not None
+compliance = ti.field(real, shape=n - 1)
+multiplier = ti.field(real, shape=n - 1)
+warm_dir = ti.Vector.field(2, real, shape=n - 1)  # multiplier times direction
+# mixed precision, see --precision: all but the last --refine iterations of
+# a frame solve in f32 for the displacement from the f64 state, about its
+# f64 edge vectors and constraints, the rest run on the f64 state
+mixed = args.precision == "mixed"
+bulk = ti.f32 if mixed else real
+disp = ti.Vector.field(n=2, dtype=bulk, shape=n)
+# per edge: the f64 edge vector e0, its length and constraint, rounded
+edge_bulk = ti.Vector.field(n=4, dtype=bulk, shape=n - 1)
+inv_mass_bulk = ti.field(bulk, shape=n)
+gradient_bulk = ti.Vector.field(n=2, dtype=bulk, shape=n - 1)
+constraint_bulk = ti.field(bulk, shape=n - 1)
+# dual residual of every iteration of the last K frames, see --residual-every
+residual_history = ti.field(real, shape=(max(args.residual_every, 1), MaxIte))
+# Chebyshev acceleration, see chebyshev.py
+use_chebyshev = args.solver == "chebyshev"
+cheb = ChebyshevAccelerator(args.cheb_warmup, args.rho,
+                            dtype=real_numpy_type(args))
+pre_pos = ti.Vector.field(n=2, dtype=real, shape=n)  # x_k
+prev_pos = ti.Vector.field(n=2, dtype=real, shape=n)  # x_{k-1}
+omega_schedule = ti.field(real, shape=MaxIte)
+cheb_best = ti.field(real, shape=())
+cheb_diverged = ti.field(ti.i32, shape=())
+# Anderson acceleration, see anderson.py
+use_anderson = args.solver == "anderson"
+anderson = None
+if use_anderson:
+    from anderson import Anderson
+    anderson = Anderson(pos, args.anderson_m)
 
 
 @ti.kernel
@@ -36,68 +100,388 @@ def init_constrint():
         rest_len[i] = (pos[idx0] - pos[idx1]).norm()
 
 
-@ti.kernel
-def seme_euler(h: ti.f32):
+@ti.func
+def seme_euler_particle(i, h):
     gravity = ti.Vector([0.0, -9.8])
+    if inv_mass[i] != 0.0:
+        vel[i] += h * gravity
+        old_pos[i] = pos[i]
+        pos[i] += vel[i] * h
+
+
+@ti.kernel
+def seme_euler(h: real):
     for i in range(n):
-        if inv_mass[i] != 0.0:
-            vel[i] += h * gravity
-            old_pos[i] = pos[i]
-            pos[i] += vel[i] * h
+        seme_euler_particle(i, h)
+
+
+@ti.func
+def eval_constraint(i):
+    idx0, idx1 = edge[i]
+    dis = pos[idx0] - pos[idx1]
+    constraint[i] = dis.norm() - rest_len[i]
+    if ti.static(xpbd):
+        # the XPBD residual C + alpha / h^2 * lambda
+        constraint[i] += compliance[i] * multiplier[i]
+    gradient[i] = dis.normalized()
+    return constraint[i]**2
+
+
+@ti.func
+def eval_constraint_bulk(i):
+    idx0, idx1 = edge[i]
+    e = edge_bulk[i]
+    e0 = ti.Vector([e[0], e[1]])
+    d = disp[idx0] - disp[idx1]
+    dis = e0 + d
+    length = dis.norm()
+    # C0 + |e0 + d| - |e0|, without subtracting the rounded lengths
+    c = e[3] + (2 * e0 + d).dot(d) / (length + e[2])
+    if ti.static(xpbd):
+        c += ti.cast(compliance[i] * multiplier[i], bulk)
+    constraint_bulk[i] = c
+    gradient_bulk[i] = dis / length
+    return c**2
 
 
 @ti.kernel
-def compute_gradient_constraint() -> ti.f32:
+def compute_gradient_constraint() -> real:
     dual_residual = 0.0
     for i in range(n - 1):
-        idx0, idx1 = edge[i]
-        dis = pos[idx0] - pos[idx1]
-        constraint[i] = dis.norm() - rest_len[i]
-        gradient[i] = dis.normalized()
-        dual_residual += constraint[i]**2
+        dual_residual += eval_constraint(i)
     return dual_residual
 
 
+@ti.func
+def record_residual(slot, ite, dual_residual):
+    residual_history[slot, ite] = dual_residual
+    # frames run with precomputed Chebyshev weights fall back to plain
+    # Jacobi once the (squared) residual grows past the divergence ratio
+    if ite >= ti.static(cheb.warmup):
+        if dual_residual > ti.static(cheb.divergence**2) * cheb_best[None]:
+            cheb_diverged[None] = 1
+        cheb_best[None] = ti.min(cheb_best[None], dual_residual)
+
+
+@ti.func
+def reset_guard():
+    cheb_best[None] = 1e30
+    cheb_diverged[None] = 0
+
+
+@ti.kernel
+def reset_divergence_guard():
+    reset_guard()
+
+
+@ti.kernel
+def compute_gradient_constraint_history(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
+    record_residual(slot, ite, dual_residual)
+
+
+@ti.func
+def solve_edge_of(i, x: ti.template(), m_inv: ti.template(),
+                  c: ti.template(), g: ti.template()):
+    idx0, idx1 = edge[i]
+    invM0, invM1 = m_inv[idx0], m_inv[idx1]
+    w = invM0 + invM1
+    if ti.static(xpbd):
+        w += ti.cast(compliance[i], c.dtype)
+    l = -c[i] / w
+    if ti.static(xpbd):
+        multiplier[i] += 0.8 * l
+    if invM0 != 0.0:
+        x[idx0] += ti.cast(0.8 * invM0 * l * g[i], c.dtype)
+    if invM1 != 0.0:
+        x[idx1] -= ti.cast(0.8 * invM1 * l * g[i], c.dtype)
+
+
+@ti.func
+def solve_edge(i):
+    solve_edge_of(i, pos, inv_mass, constraint, gradient)
+
+
+@ti.func
+def warm_start_direction(i):
+    # start from the last frame's multipliers: move the predicted positions
+    # by the correction M^-1 grad C^T lambda they stand for, with every
+    # direction taken before any position moves
+    multiplier[i] *= ti.static(args.warm_start)
+    idx0, idx1 = edge[i]
+    warm_dir[i] = multiplier[i] * (pos[idx0] - pos[idx1]).normalized()
+
+
+@ti.func
+def warm_start_edge(i):
+    idx0, idx1 = edge[i]
+    pos[idx0] += inv_mass[idx0] * warm_dir[i]
+    pos[idx1] -= inv_mass[idx1] * warm_dir[i]
+
+
+@ti.kernel
+def warm_start():
+    for i in range(n - 1):
+        warm_start_direction(i)
+    for i in range(n - 1):
+        warm_start_edge(i)
+
+
 @ti.kernel
 def solve_constraints():
+    for i in range(n - 1):
+        solve_edge(i)
+
+
+@ti.kernel
+def init_bulk():
+    for i in range(n):
+        inv_mass_bulk[i] = inv_mass[i]
+
+
+@ti.kernel
+def to_bulk():
+    for i in range(n):
+        disp[i] = ti.Vector.zero(bulk, 2)
     for i in range(n - 1):
         idx0, idx1 = edge[i]
-        invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
-        l = -constraint[i] / (invM0 + invM1)
-        if invM0 != 0.0:
-            pos[idx0] += 0.8 * invM0 * l * gradient[i]
-        if invM1 != 0.0:
-            pos[idx1] -= 0.8 * invM1 * l * gradient[i]
+        dis = pos[idx0] - pos[idx1]
+        length = dis.norm()
+        edge_bulk[i] = ti.cast(ti.Vector([dis[0], dis[1], length,
+                                          length - rest_len[i]]), bulk)
+
+
+@ti.kernel
+def from_bulk():
+    for i in range(n):
+        pos[i] += ti.cast(disp[i], real)
+
+
+@ti.kernel
+def compute_gradient_constraint_bulk() -> real:
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint_bulk(i)
+    return dual_residual
+
+
+@ti.kernel
+def compute_gradient_constraint_history_bulk(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint_bulk(i)
+    residual_history[slot, ite] = dual_residual
+
+
+@ti.kernel
+def solve_constraints_bulk():
+    for i in range(n - 1):
+        solve_edge_of(i, disp, inv_mass_bulk, constraint_bulk, gradient_bulk)
+
+
+@ti.kernel
+def copy_pos():
+    for i in range(n):
+        pre_pos[i] = pos[i]
+
+
+@ti.func
+def chebyshev_particle(i, omega):
+    w = omega
+    if cheb_diverged[None]:
+        w = 1.0
+    pos[i] = prev_pos[i] + w * (pos[i] - prev_pos[i])
+    prev_pos[i] = pre_pos[i]
+
 
+@ti.kernel
+def apply_chebyshev(omega: real):
+    for i in range(n):
+        chebyshev_particle(i, omega)
 
 
+def solve_bulk(ite):
+    if history is None:
+        dual_residual = compute_gradient_constraint_bulk()
+    else:
+        dual_residual = None
+        compute_gradient_constraint_history_bulk(history.slot, ite)
+    solve_constraints_bulk()
+    return dual_residual
 
 
-def solve():
-    dual_residual = compute_gradient_constraint()
+def solve(ite):
+    if args.fuse == "iteration":
+        fused_iteration(history.slot, ite, omegas[ite])
+        return None
+    if use_chebyshev:
+        copy_pos()
+    elif use_anderson:
+        anderson.begin()
+    if history is None:
+        dual_residual = compute_gradient_constraint()
+    else:
+        # no return value, the iteration loop does not wait for the device
+        dual_residual = None
+        compute_gradient_constraint_history(history.slot, ite)
     solve_constraints()
+    if use_chebyshev:
+        # residuals on the device: weights from the last read-back frames
+        apply_chebyshev(omegas[ite] if history is not None
+                        else cheb.step(math.sqrt(dual_residual)))
+    elif use_anderson:
+        with profiler.phase("anderson_mix"):
+            anderson.mix()
     return dual_residual
 
 
+@ti.func
+def update_vel_particle(i, h):
+    if inv_mass[i] != 0.0:
+        vel[i] = (pos[i] - old_pos[i]) / h
+
+
 @ti.kernel
-def update_vel(h: ti.f32):
+def update_vel(h: real):
     for i in range(n):
-        if inv_mass[i] != 0.0:
-            vel[i] = (pos[i] - old_pos[i]) / h
+        update_vel_particle(i, h)
+
+
+@ti.kernel
+def fused_iteration(slot: ti.i32, ite: ti.i32, omega: real):
+    # one launch per iteration: the top-level loops still run in parallel,
+    # one after the other
+    if ti.static(use_chebyshev):
+        for i in range(n):
+            pre_pos[i] = pos[i]
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
+    record_residual(slot, ite, dual_residual)
+    for i in range(n - 1):
+        solve_edge(i)
+    if ti.static(use_chebyshev):
+        for i in range(n):
+            chebyshev_particle(i, omega)
+
 
+@ti.kernel
+def fused_frame(h: real, slot: ti.i32):
+    # one launch per frame: the outer loop serializes everything inside it,
+    # which beats launch overhead for small and medium rods
+    for _ in range(1):
+        reset_guard()
+        for i in range(n):
+            seme_euler_particle(i, h)
+        if ti.static(xpbd):
+            for i in range(n - 1):
+                warm_start_direction(i)
+            for i in range(n - 1):
+                warm_start_edge(i)
+        for ite in range(MaxIte):
+            if ti.static(use_chebyshev):
+                for i in range(n):
+                    pre_pos[i] = pos[i]
+            dual_residual = 0.0
+            for i in range(n - 1):
+                dual_residual += eval_constraint(i)
+            record_residual(slot, ite, dual_residual)
+            for i in range(n - 1):
+                solve_edge(i)
+            if ti.static(use_chebyshev):
+                for i in range(n):
+                    chebyshev_particle(i, omega_schedule[ite])
+        for i in range(n):
+            update_vel_particle(i, h)
+
+
+recorder = ResidualRecorder(args.residual_log or "data/Jacobi.bin",
+                            args.solver, squared=True)
+recorder.flush = profiler.timed("residual_io")(recorder.flush)
+history = None
+if args.residual_every > 0 or args.fuse != "none":
+    history = DeviceResidualHistory(residual_history, recorder)
+omegas = cheb.schedule(MaxIte)
+omega_schedule.from_numpy(omegas)
+control = IterationController.from_args(args, squared=True)
 
+
+@profiler.frame
 def update(h):
-    seme_euler(h)
-    f = open(f"data/Jacobi.txt", 'a')
-    for i in range(MaxIte):
-        dual_residual = solve()
-        f.write(f"{dual_residual}  \n")
-    update_vel(h)
+    recorder.new_frame()
+    if args.fuse == "frame":
+        fused_frame(h, history.slot)
+        iterations = control.end_frame(MaxIte)
+    else:
+        seme_euler(h)
+        if xpbd:
+            warm_start()
+        cheb.new_frame()
+        if use_anderson:
+            anderson.new_frame()
+        if history is not None and use_chebyshev:
+            reset_divergence_guard()
+        control.new_frame()
+        bulk_phase = mixed and args.refine < MaxIte
+        if bulk_phase:
+            to_bulk()
+        for i in range(MaxIte):
+            if bulk_phase and i == MaxIte - args.refine:
+                from_bulk()
+                bulk_phase = False
+            dual_residual = solve_bulk(i) if bulk_phase else solve(i)
+            if history is None:
+                recorder.record(i, dual_residual)
+            if control.done(i, dual_residual):
+                break
+        if bulk_phase:  # the tolerance was met in f32
+            from_bulk()
+        iterations = control.end_frame()
+        update_vel(h)
+    if history is not None:
+        end_frame(iterations)
 
 
-gui = ti.GUI("Display Rod", res=(500, 500))
+def end_frame(iterations):
+    global omegas
+    frame = history.frame
+    history.end_frame(iterations)
+    if use_chebyshev and history.frame != frame:
+        cheb.observe(np.sqrt(history.last))
+        omegas = cheb.schedule(MaxIte)
+        omega_schedule.from_numpy(omegas)
+
+
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h)
+    return control.total - total
+
+
+cache.prewarm(globals())
+profiler.wrap_kernels(globals())
 init_pos()
 init_constrint()
+if xpbd:
+    compliance.fill(args.compliance / h**2)
+state = dict(pos=pos, old_pos=old_pos, vel=vel, inv_mass=inv_mass,
+             rest_len=rest_len, edge=edge)
+restore(args, state)
+if mixed:
+    init_bulk()
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(pos, edge, rest_len),
+                 stats=[{"chebyshev": cheb.stats,
+                         "anderson": getattr(anderson, "stats", None)
+                         }.get(args.solver), control.stats, cache.stats],
+                 reset=control.reset, n=n)
+    checkpoint(args, state)
+    raise SystemExit
+
+gui = ti.GUI("Display Rod", res=(500, 500))
 while gui.running:
 
     gui.get_event(ti.GUI.PRESS)
@@ -109,9 +493,11 @@ while gui.running:
     if not pause:
         update(h)
 
-    positions = pos.to_numpy()
-    begin_points = positions[:-1]
-    end_points = positions[1:]
-    gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
-    gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
-    gui.show()
+    with profiler.phase("render"):
+        positions = pos.to_numpy()
+        begin_points = positions[:-1]
+        end_points = positions[1:]
+        gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
+        gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
+        gui.show()
+checkpoint(args, state)
@@ -3,20 +3,55 @@ Schur complement with Multi-grid Jacobi solver
 """
 import taichi as ti
 import numpy as np
+from headless import make_parser, run_headless, edge_residual, real_type
+from residual_log import ResidualRecorder, DeviceResidualHistory
+from controller import IterationController
+from profiling import Profiler
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+from trajectory import TrajectoryRecorder
+from schur import SchurPattern, MatrixFreeSchur
+from linear_solvers import Thomas_solve
 
-ti.init(arch=ti.gpu)
+parser = make_parser(__doc__, n=101, h=0.01, max_ite=5,
+                     solvers=("fake_amgx", "jacobi", "tridiag"), arch="gpu",
+                     history=True, fuse=True, control=True, profile=True,
+                     record=True, xpbd=True, precision=("f64", "f32"))
+parser.add_argument("--matrix-free", action="store_true",
+                    help="keep G, A and the solve inside Taichi kernels")
+args = parser.parse_args()
+if args.fuse != "none" and not args.matrix_free:
+    parser.error("--fuse needs --matrix-free, the assembled solve runs on "
+                 "the host")
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+profiler = Profiler.from_args(args)
 
-n = 101
-pos = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
-old_pos = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
+n = args.n
+pos = ti.Vector.field(n=2, dtype=real, shape=n)
+old_pos = ti.Vector.field(n=2, dtype=real, shape=n)
 edge = ti.Vector.field(n=2, dtype=ti.i32, shape=n - 1)
-rest_len = ti.field(dtype=ti.f64, shape=n - 1)
-inv_mass = ti.field(dtype=ti.f64, shape=n)
-vel = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
-h, MaxIte = 0.01, 5  # time step size: 10ms, Maximu iteration number
+rest_len = ti.field(dtype=real, shape=n - 1)
+inv_mass = ti.field(dtype=real, shape=n)
+vel = ti.Vector.field(n=2, dtype=real, shape=n)
+h, MaxIte = args.h, args.max_ite  # time step size: 10ms, Maximu iteration number
 pause = False
-gradient = ti.Vector.field(n=2, dtype=ti.f64, shape=n - 1)
-constraint = ti.field(ti.f64, shape=n - 1)
+gradient = ti.Vector.field(n=2, dtype=real, shape=n - 1)
+constraint = ti.field(real, shape=n - 1)
+# XPBD, see --compliance: compliance / h^2 and accumulated multiplier per edge
+xpbd = args.compliance is not None
+compliance = ti.field(real, shape=n - 1)
+multiplier = ti.field(real, shape=n - 1)
+warm_dir = ti.Vector.field(2, real, shape=n - 1)  # multiplier times direction
+alpha = None  # compliance on the host, shifts the diagonal of A
+# dual residual of every iteration of the last K frames, see --residual-every
+residual_history = ti.field(real, shape=(max(args.residual_every, 1), MaxIte))
+use_amgx = int(args.solver == "fake_amgx")
+# G, A = G^T G and the solves on the device, see schur.MatrixFreeSchur
+matrix_free = MatrixFreeSchur(pos, edge, inv_mass, gradient, constraint,
+                              compliance, multiplier, xpbd)
+tridiag = args.solver == "tridiag"
 
 
 @ti.kernel
@@ -37,100 +72,254 @@ def init_constrint():
         rest_len[i] = (pos[idx0] - pos[idx1]).norm()
 
 
-@ti.kernel
-def seme_euler(h: ti.f64):
+@ti.func
+def seme_euler_particle(i, h):
     gravity = ti.Vector([0.0, -9.8])
+    if inv_mass[i] != 0.0:
+        vel[i] += h * gravity
+        old_pos[i] = pos[i]
+        pos[i] += vel[i] * h
+
+
+@ti.kernel
+def seme_euler(h: real):
     for i in range(n):
-        if inv_mass[i] != 0.0:
-            vel[i] += h * gravity
-            old_pos[i] = pos[i]
-            pos[i] += vel[i] * h
+        seme_euler_particle(i, h)
+
+
+@ti.func
+def warm_start_direction(i):
+    # start from the last frame's multipliers: move the predicted positions
+    # by the correction M^-1 G lambda they stand for, with every
+    # direction taken before any position moves
+    multiplier[i] *= ti.static(args.warm_start)
+    idx0, idx1 = edge[i]
+    warm_dir[i] = multiplier[i] * (pos[idx0] - pos[idx1]).normalized()
+
+
+@ti.func
+def warm_start_edge(i):
+    idx0, idx1 = edge[i]
+    pos[idx0] += inv_mass[idx0] * warm_dir[i]
+    pos[idx1] -= inv_mass[idx1] * warm_dir[i]
+
+
+@ti.kernel
+def warm_start():
+    for i in range(n - 1):
+        warm_start_direction(i)
+    for i in range(n - 1):
+        warm_start_edge(i)
+
+
+@ti.func
+def eval_constraint(i):
+    idx0, idx1 = edge[i]
+    dis = pos[idx0] - pos[idx1]
+    constraint[i] = dis.norm() - rest_len[i]
+    if ti.static(xpbd):
+        # the XPBD residual C + alpha / h^2 * lambda
+        constraint[i] += compliance[i] * multiplier[i]
+    gradient[i] = dis.normalized()
+    return constraint[i]**2
 
 
 @ti.kernel
-def compute_gradient_constraint() -> ti.f64:
+def compute_gradient_constraint() -> real:
     dual_residual = 0.0
     for i in range(n - 1):
-        idx0, idx1 = edge[i]
-        dis = pos[idx0] - pos[idx1]
-        constraint[i] = dis.norm() - rest_len[i]
-        gradient[i] = dis.normalized()
-        dual_residual += constraint[i]**2
+        dual_residual += eval_constraint(i)
     return dual_residual
 
 
 @ti.kernel
-def correct(delta_x: ti.ext_arr()):
+def compute_gradient_constraint_history(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
+    residual_history[slot, ite] = dual_residual
+
+
+@ti.kernel
+def correct(delta_x: ti.types.ndarray()):
     for i in range(n-1):
         pos[i+1] += ti.Vector([delta_x[2 * i + 0], delta_x[2 * i + 1]])
 
 
-def Jacobi_solve(A, b):
-    l = np.zeros(n - 1, np.float64)
+@ti.kernel
+def accumulate(delta_lambda: ti.types.ndarray()):
     for i in range(n - 1):
-        l[i] = b[i] / A[i, i]
-    return l
+        multiplier[i] += delta_lambda[i]
+
+
+def Jacobi_solve(A, b):
+    return b / A.diagonal()
+
+
+linear_solve = Thomas_solve if args.solver == "tridiag" else Jacobi_solve
 
 
 def solve_constraints(use_amgx):
-    g = gradient.to_numpy()
-    G = np.zeros((2 * n, n - 1), np.float64)
-    e_indices = edge.to_numpy()
-    for i in range(n - 1):
-        idx0, idx1 = e_indices[i]
-        G[2 * idx0:2 * idx0 + 2, i] = g[i]
-        G[2 * idx1:2 * idx1 + 2, i] = -g[i]
-    G = G[2:,:]
-    A = np.transpose(G) @ G 
-    b = -constraint.to_numpy()
-    l = Jacobi_solve(A, b)
-    # AMGX
-    if use_amgx:
-        r = b - A @ l
-        nl2 = (n-1)//2
-        d = np.zeros(nl2, np.float64)
-        for i in range(nl2):
-            c = r[2*i] + r[2*i+1]
-            denomitor = 4 - 2 * np.dot(g[2*i], g[2*i+1])
-            d[i] = c / denomitor
-            l[2*i] +=   d[i]
-            l[2*i+1] +=  d[i]
-        #Post-smoothings
-        # r = b - A @ l
-        # x = Jacobi_solve(A, r)
-        # l += x
-
-    delta_x = 0.8 * G @ l
+    with profiler.phase("assemble"):
+        g = gradient.to_numpy()
+        G, A = pattern.assemble(g, alpha)
+        b = -constraint.to_numpy()
+    with profiler.phase("linear_solve"):
+        l = linear_solve(A, b)
+        # AMGX
+        if use_amgx:
+            r = b - A @ l
+            nl2 = (n-1)//2
+            even, odd = slice(0, 2 * nl2, 2), slice(1, 2 * nl2, 2)
+            c = r[even] + r[odd]
+            denomitor = 4 - 2 * np.einsum("ij,ij->i", g[even], g[odd])
+            if xpbd:
+                denomitor += alpha[even] + alpha[odd]
+            d = c / denomitor
+            l[even] += d
+            l[odd] += d
+            #Post-smoothings
+            # r = b - A @ l
+            # x = Jacobi_solve(A, r)
+            # l += x
+
+        delta_x = 0.8 * G @ l
     correct(delta_x)
+    if xpbd:
+        accumulate(0.8 * l)
 
 
-def solve(use_amgx):
-    dual_residual = compute_gradient_constraint()
-    solve_constraints(use_amgx)
+def solve(ite, use_amgx):
+    if args.fuse == "iteration":
+        fused_iteration(history.slot, ite)
+        return None
+    if history is None:
+        dual_residual = compute_gradient_constraint()
+    else:
+        # no return value, the iteration loop does not wait for the device
+        dual_residual = None
+        compute_gradient_constraint_history(history.slot, ite)
+    if args.matrix_free:
+        matrix_free.solve(tridiag, use_amgx)
+    else:
+        solve_constraints(use_amgx)
     return dual_residual
 
 
+@ti.func
+def update_vel_particle(i, h):
+    if inv_mass[i] != 0.0:
+        vel[i] = (pos[i] - old_pos[i]) / h
+
+
 @ti.kernel
-def update_vel(h: ti.f64):
+def update_vel(h: real):
     for i in range(n):
-        if inv_mass[i] != 0.0:
-            vel[i] = (pos[i] - old_pos[i]) / h
+        update_vel_particle(i, h)
+
+
+@ti.kernel
+def fused_iteration(slot: ti.i32, ite: ti.i32):
+    # one launch per iteration: the top-level loops still run in parallel,
+    # one after the other
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
+    residual_history[slot, ite] = dual_residual
+    matrix_free.iteration(tridiag, use_amgx)
+
+
+@ti.kernel
+def fused_frame(h: real, slot: ti.i32):
+    # one launch per frame: the outer loop serializes everything inside it,
+    # which beats launch overhead for small and medium rods
+    for _ in range(1):
+        for i in range(n):
+            seme_euler_particle(i, h)
+        if ti.static(xpbd):
+            for i in range(n - 1):
+                warm_start_direction(i)
+            for i in range(n - 1):
+                warm_start_edge(i)
+        for ite in range(MaxIte):
+            dual_residual = 0.0
+            for i in range(n - 1):
+                dual_residual += eval_constraint(i)
+            residual_history[slot, ite] = dual_residual
+            matrix_free.iteration(tridiag, use_amgx)
+        for i in range(n):
+            update_vel_particle(i, h)
+
+
+recorder = ResidualRecorder(args.residual_log or "data/SC_Fake_AMGX.bin",
+                            args.solver, squared=True)
+recorder.flush = profiler.timed("residual_io")(recorder.flush)
+history = None
+if args.residual_every > 0 or args.fuse != "none":
+    history = DeviceResidualHistory(residual_history, recorder)
+control = IterationController.from_args(args, squared=True)
+trajectory = None  # see --record
 
 
+@profiler.frame
 def update(h):
-    seme_euler(h)
-    f = open(f"data/SC_Fake_AMGX.txt", 'a')
-    for i in range(MaxIte):
-        # AMGX: 1, NO_AMGX: 0
-        dual_residual = solve(1)
-        f.write(f"{dual_residual}  \n")
-    update_vel(h)
+    recorder.new_frame()
+    if args.fuse == "frame":
+        fused_frame(h, history.slot)
+        iterations = control.end_frame(MaxIte)
+    else:
+        seme_euler(h)
+        if xpbd:
+            warm_start()
+        control.new_frame()
+        for i in range(MaxIte):
+            # AMGX: 1, NO_AMGX: 0
+            dual_residual = solve(i, use_amgx)
+            if history is None:
+                recorder.record(i, dual_residual)
+            if control.done(i, dual_residual):
+                break
+        iterations = control.end_frame()
+        update_vel(h)
+    if history is not None:
+        history.end_frame(iterations)
+    if trajectory is not None:
+        with profiler.phase("record"):
+            trajectory.record(pos)
 
 
-gui = ti.GUI("Display Rod", res=(500, 500))
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h)
+    return control.total - total
+
+
+cache.prewarm(globals())
+profiler.wrap_kernels(globals())
+profiler.wrap_kernels(matrix_free)
 init_pos()
 init_constrint()
-frame = 0
+if xpbd:
+    compliance.fill(args.compliance / h**2)
+    alpha = compliance.to_numpy()
+state = dict(pos=pos, old_pos=old_pos, vel=vel, inv_mass=inv_mass,
+             rest_len=rest_len, edge=edge)
+restore(args, state)
+pattern = SchurPattern(edge.to_numpy(), n)  # topology is static
+if args.record is not None:
+    trajectory = TrajectoryRecorder(
+        args.record, args.record_frames, n, edge.to_numpy(), h=h, res=500,
+        line_radius=4, line_color=0x00FF00, vertex_radius=5,
+        vertex_color=0xFF0000)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(pos, edge, rest_len),
+                 stats=[control.stats, cache.stats], reset=control.reset,
+                 n=n)
+    checkpoint(args, state)
+    raise SystemExit
+
+gui = ti.GUI("Display Rod", res=(500, 500))
 while gui.running:
 
     gui.get_event(ti.GUI.PRESS)
@@ -142,14 +331,14 @@ while gui.running:
     if not pause:
         update(h)
 
-    positions = pos.to_numpy()
-    begin_points = positions[:-1]
-    end_points = positions[1:]
-    gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
-    gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
-    # gui.show()
-    filename = f'./video/frame_{frame:05d}.png'  
-    frame += 1
-    if frame == 2000:
+    with profiler.phase("render"):
+        positions = pos.to_numpy()
+        begin_points = positions[:-1]
+        end_points = positions[1:]
+        gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
+        gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
+        gui.show()
+    # frames are rendered offline from the trajectory, render_trajectory.py
+    if trajectory is not None and trajectory.full:
         break
-    gui.show(filename)
\ No newline at end of file
+checkpoint(args, state)
@@ -1,15 +1,36 @@
 """
-Schur complement with Multi-grid Jacobi solver
+Schur complement with algebraic multigrid solver (pyamgx or CPU fallback)
 """
 import taichi as ti
 import numpy as np
-import pyamgx 
-import scipy.sparse as sparse
-
-pyamgx.initialize()
-
-# Initialize config and resources:
-cfg = pyamgx.Config().create_from_dict({
+from headless import make_parser, run_headless, edge_residual, real_type
+from residual_log import ResidualRecorder, DeviceResidualHistory
+from controller import IterationController
+from profiling import Profiler
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+from trajectory import TrajectoryRecorder
+from schur import SchurPattern
+from linear_solvers import Thomas_solve
+from amg import make_backend, CachedHierarchy
+
+parser = make_parser(__doc__, n=101, h=0.01, max_ite=5,
+                     solvers=("amgx", "jacobi", "tridiag"), arch="gpu",
+                     history=True, control=True, profile=True,
+                     record=True, xpbd=True, precision=("f64", "f32"))
+parser.add_argument("--backend", choices=("auto", "amgx", "cpu"),
+                    default="auto",
+                    help="AMG backend: pyamgx, the CPU AMG in amg.py, or "
+                         "pyamgx when it is installed")
+parser.add_argument("--amg-reuse", choices=CachedHierarchy.policies,
+                    default="always",
+                    help="when to redo the AMG setup, see amg.CachedHierarchy")
+parser.add_argument("--max-levels", type=int, default=1,
+                    help="AMG hierarchy depth; with 1 the V-cycle is a "
+                         "smoothed direct solve")
+args = parser.parse_args()
+
+cfg = {
     "config_version": 2,
     "solver": {
         "print_grid_stats": 0,
@@ -25,37 +46,42 @@ cfg = pyamgx.Config().create_from_dict({
         "monitor_residual": 1,
         "convergence": "ABSOLUTE",
         "scope": "main",
-        "max_levels": 1,
+        "max_levels": args.max_levels,
         "cycle": "V",
         "tolerance": 1e-06,
         "norm": "L2"
     }
-})
-
-rsc = pyamgx.Resources().create_simple(cfg)
-
-# Create matrices and vectors:
-A_glb = pyamgx.Matrix().create(rsc)
-b_glb = pyamgx.Vector().create(rsc)
-x_glb = pyamgx.Vector().create(rsc)
+}
 
 # Create solver:
-solver = pyamgx.Solver().create(rsc, cfg)
+amg = CachedHierarchy(make_backend(cfg, args.backend), args.amg_reuse)
 
 
-ti.init(arch=ti.gpu)
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+profiler = Profiler.from_args(args)
 
-n = 101
-pos = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
-old_pos = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
+n = args.n
+pos = ti.Vector.field(n=2, dtype=real, shape=n)
+old_pos = ti.Vector.field(n=2, dtype=real, shape=n)
 edge = ti.Vector.field(n=2, dtype=ti.i32, shape=n - 1)
-rest_len = ti.field(dtype=ti.f64, shape=n - 1)
-inv_mass = ti.field(dtype=ti.f64, shape=n)
-vel = ti.Vector.field(n=2, dtype=ti.f64, shape=n)
-h, MaxIte = 0.01, 5  # time step size: 10ms, Maximu iteration number
+rest_len = ti.field(dtype=real, shape=n - 1)
+inv_mass = ti.field(dtype=real, shape=n)
+vel = ti.Vector.field(n=2, dtype=real, shape=n)
+h, MaxIte = args.h, args.max_ite  # time step size: 10ms, Maximu iteration number
 pause = False
-gradient = ti.Vector.field(n=2, dtype=ti.f64, shape=n - 1)
-constraint = ti.field(ti.f64, shape=n - 1)
+gradient = ti.Vector.field(n=2, dtype=real, shape=n - 1)
+constraint = ti.field(real, shape=n - 1)
+# XPBD, see --compliance: compliance / h^2 and accumulated multiplier per edge
+xpbd = args.compliance is not None
+compliance = ti.field(real, shape=n - 1)
+multiplier = ti.field(real, shape=n - 1)
+warm_dir = ti.Vector.field(2, real, shape=n - 1)  # multiplier times direction
+alpha = None  # compliance on the host, shifts the diagonal of A
+# dual residual of every iteration of the last K frames, see --residual-every
+residual_history = ti.field(real, shape=(max(args.residual_every, 1), MaxIte))
+use_amgx = int(args.solver == "amgx")
 
 
 @ti.kernel
@@ -77,7 +103,7 @@ def init_constrint():
 
 
 @ti.kernel
-def seme_euler(h: ti.f64):
+def seme_euler(h: real):
     gravity = ti.Vector([0.0, -9.8])
     for i in range(n):
         if inv_mass[i] != 0.0:
@@ -87,95 +113,178 @@ def seme_euler(h: ti.f64):
 
 
 @ti.kernel
-def compute_gradient_constraint() -> ti.f64:
-    dual_residual = 0.0
+def warm_start():
+    # start from the last frame's multipliers: move the predicted positions
+    # by the correction M^-1 G lambda they stand for, with every direction
+    # taken before any position moves
     for i in range(n - 1):
+        multiplier[i] *= ti.static(args.warm_start)
         idx0, idx1 = edge[i]
-        dis = pos[idx0] - pos[idx1]
-        constraint[i] = dis.norm() - rest_len[i]
-        gradient[i] = dis.normalized()
-        dual_residual += constraint[i]**2
+        warm_dir[i] = multiplier[i] * (pos[idx0] - pos[idx1]).normalized()
+    for i in range(n - 1):
+        idx0, idx1 = edge[i]
+        pos[idx0] += inv_mass[idx0] * warm_dir[i]
+        pos[idx1] -= inv_mass[idx1] * warm_dir[i]
+
+
+@ti.func
+def eval_constraint(i):
+    idx0, idx1 = edge[i]
+    dis = pos[idx0] - pos[idx1]
+    constraint[i] = dis.norm() - rest_len[i]
+    if ti.static(xpbd):
+        # the XPBD residual C + alpha / h^2 * lambda
+        constraint[i] += compliance[i] * multiplier[i]
+    gradient[i] = dis.normalized()
+    return constraint[i]**2
+
+
+@ti.kernel
+def compute_gradient_constraint() -> real:
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
     return dual_residual
 
 
 @ti.kernel
-def correct(delta_x: ti.ext_arr()):
+def compute_gradient_constraint_history(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(n - 1):
+        dual_residual += eval_constraint(i)
+    residual_history[slot, ite] = dual_residual
+
+
+@ti.kernel
+def correct(delta_x: ti.types.ndarray()):
     for i in range(n-1):
         pos[i+1] += ti.Vector([delta_x[2 * i + 0], delta_x[2 * i + 1]])
 
 
-def Jacobi_solve(A, b):
-    l = np.zeros(n - 1, np.float64)
+@ti.kernel
+def accumulate(delta_lambda: ti.types.ndarray()):
     for i in range(n - 1):
-        l[i] = b[i] / A[i, i]
-    return l
+        multiplier[i] += delta_lambda[i]
 
-def AMGX_solve(A,b):
-    M = sparse.csr_matrix(A)
-    rhs = b
-    sol = np.zeros(n-1, np.float64)
-    A_glb.upload_CSR(M)
-    b_glb.upload(rhs)
-    x_glb.upload(sol)
 
-    # Setup and solve system:
-    solver.setup(A_glb)
-    solver.solve(b_glb, x_glb)
+def Jacobi_solve(A, b):
+    return b / A.diagonal()
 
-    # Download solution
-    x_glb.download(sol)
-    return sol
 
+linear_solve = Thomas_solve if args.solver == "tridiag" else Jacobi_solve
+
+def AMGX_solve(A, b):
+    # Setup (as the reuse policy requires) and solve system:
+    return amg.solve(A, b)
 
-def solve_constraints(use_amgx):
-    g = gradient.to_numpy()
-    G = np.zeros((2 * n, n - 1), np.float64)
-    e_indices = edge.to_numpy()
-    for i in range(n - 1):
-        idx0, idx1 = e_indices[i]
-        G[2 * idx0:2 * idx0 + 2, i] = g[i]
-        G[2 * idx1:2 * idx1 + 2, i] = -g[i]
-    G = G[2:,:]
-    A = np.transpose(G) @ G 
-    b = -constraint.to_numpy()
-    # l = Jacobi_solve(A, b)
-    # AMGX
-    if use_amgx:
-        l = AMGX_solve(A,b)
-    else:
-        l = Jacobi_solve(A,b)
 
-    delta_x = 0.8 * G @ l
+def solve_constraints(use_amgx):
+    with profiler.phase("assemble"):
+        g = gradient.to_numpy()
+        G, A = pattern.assemble(g, alpha)
+        b = -constraint.to_numpy()
+    with profiler.phase("linear_solve"):
+        # l = Jacobi_solve(A, b)
+        # AMGX
+        if use_amgx:
+            l = AMGX_solve(A,b)
+        else:
+            l = linear_solve(A, b)
+
+        delta_x = 0.8 * G @ l
     correct(delta_x)
+    if xpbd:
+        accumulate(0.8 * l)
 
 
-def solve(use_amgx):
-    dual_residual = compute_gradient_constraint()
+def solve(ite, use_amgx):
+    if history is None:
+        dual_residual = compute_gradient_constraint()
+    else:
+        # no return value, the iteration loop does not wait for the device
+        dual_residual = None
+        compute_gradient_constraint_history(history.slot, ite)
     solve_constraints(use_amgx)
     return dual_residual
 
 
 @ti.kernel
-def update_vel(h: ti.f64):
+def update_vel(h: real):
     for i in range(n):
         if inv_mass[i] != 0.0:
             vel[i] = (pos[i] - old_pos[i]) / h
 
 
+recorder = ResidualRecorder(args.residual_log or "data/SC_Real_AMGX.bin",
+                            args.solver, squared=True)
+recorder.flush = profiler.timed("residual_io")(recorder.flush)
+history = None
+if args.residual_every > 0:
+    history = DeviceResidualHistory(residual_history, recorder)
+control = IterationController.from_args(args, squared=True)
+trajectory = None  # see --record
+
+
+@profiler.frame
 def update(h):
     seme_euler(h)
-    f = open(f"data/SC_Real_AMGX.txt", 'a')
+    if xpbd:
+        warm_start()
+    amg.new_frame()
+    recorder.new_frame()
+    control.new_frame()
     for i in range(MaxIte):
         # AMGX: 1, NO_AMGX: 0
-        dual_residual = solve(1)
-        f.write(f"{dual_residual}  \n")
+        dual_residual = solve(i, use_amgx)
+        if history is None:
+            recorder.record(i, dual_residual)
+        if control.done(i, dual_residual):
+            break
+    iterations = control.end_frame()
+    if history is not None:
+        history.end_frame(iterations)
     update_vel(h)
+    if trajectory is not None:
+        with profiler.phase("record"):
+            trajectory.record(pos)
 
 
-gui = ti.GUI("Display Rod", res=(500, 500))
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h)
+    return control.total - total
+
+
+def clean_up():
+    amg.destroy()
+
+
+cache.prewarm(globals())
+profiler.wrap_kernels(globals())
 init_pos()
 init_constrint()
-frame = 0
+if xpbd:
+    compliance.fill(args.compliance / h**2)
+    alpha = compliance.to_numpy()
+state = dict(pos=pos, old_pos=old_pos, vel=vel, inv_mass=inv_mass,
+             rest_len=rest_len, edge=edge)
+restore(args, state)
+pattern = SchurPattern(edge.to_numpy(), n)  # topology is static
+if args.record is not None:
+    trajectory = TrajectoryRecorder(
+        args.record, args.record_frames, n, edge.to_numpy(), h=h, res=500,
+        line_radius=4, line_color=0x00FF00, vertex_radius=5,
+        vertex_color=0xFF0000)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(pos, edge, rest_len),
+                 stats=[amg.stats, control.stats, cache.stats],
+                 reset=control.reset, n=n)
+    clean_up()
+    checkpoint(args, state)
+    raise SystemExit
+
+gui = ti.GUI("Display Rod", res=(500, 500))
 while gui.running:
 
     gui.get_event(ti.GUI.PRESS)
@@ -187,26 +296,16 @@ while gui.running:
     if not pause:
         update(h)
 
-    positions = pos.to_numpy()
-    begin_points = positions[:-1]
-    end_points = positions[1:]
-    gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
-    gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
-    # gui.show()
-    filename = f'./video/frame_{frame:05d}.png'  
-    frame += 1
-    if frame == 2000:
+    with profiler.phase("render"):
+        positions = pos.to_numpy()
+        begin_points = positions[:-1]
+        end_points = positions[1:]
+        gui.lines(begin_points, end_points, radius=4, color=0x00FF00)
+        gui.circles(pos.to_numpy(), radius=5, color=0xFF0000)
+        gui.show()
+    # frames are rendered offline from the trajectory, render_trajectory.py
+    if trajectory is not None and trajectory.full:
         break
-    gui.show(filename)
-
-
-def clean_up():
-    A_glb.destroy()
-    x_glb.destroy()
-    b_glb.destroy()
-    solver.destroy()
-    rsc.destroy()
-    cfg.destroy()
-    pyamgx.finalize()
+checkpoint(args, state)
 
 clean_up()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import taichi as ti
 import numpy as np 
+from mesh_render import MeshRenderer
 
 ti.init(arch=ti.cpu)
 
@@ -49,6 +50,7 @@ def update(h):
 init_pos()
 init_edge()
 gui = ti.GUI("Diplay tri mesh", res=(600,600))
+renderer = MeshRenderer(gui, positions, edge_indices)
 pause = False
 h = 0.01
 while gui.running:
@@ -61,13 +63,5 @@ while gui.running:
     if not pause:
         update(h)
 
-    poses = positions.to_numpy()
-    edges = edge_indices.to_numpy()
-    begin_line, end_line = [], []
-    for i in range(edges.shape[0]):
-        idx1, idx2 = edges[i]
-        begin_line.append(poses[idx1])
-        end_line.append(poses[idx2])
-    gui.lines(np.asarray(begin_line), np.asarray(end_line), radius=2, color=0x0000FF) 
-    gui.circles(positions.to_numpy(), radius=6, color=0xffaa33)
+    renderer.draw()
     gui.show()
\ No newline at end of file
@@ -1,20 +1,42 @@
 import taichi as ti
 import numpy as np 
+from mesh_render import MeshRenderer
+from headless import make_parser, run_headless, edge_residual, real_type
+from coloring import color_edges
+from scenes import load_mesh, top_corners
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+from self_collision import SelfCollision
+from controller import IterationController
+from residual_log import ResidualRecorder
 
-ti.init(arch=ti.cpu)
+parser = make_parser(N=5, h=0.01, max_ite=10, solvers=("colored_gs", "gs"),
+                     arch="cpu", mesh=True, self_collision=True, control=True)
+parser.add_argument("--pin", action="store_true",
+                    help="pin the top corners as 6_pbd_mesh_jacobi.py does")
+args = parser.parse_args()
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
 
-N = 5
-NV = (N+1)**2
-NE = (N+1) * N * 2
+N = args.N
+scene = load_mesh(args.mesh) if args.mesh else None
+NV = (N+1)**2 if scene is None else len(scene.positions)
+NE = (N+1) * N * 2 if scene is None else len(scene.edges)
+pinned = [N, NV-1] if scene is None else top_corners(scene.positions)
 
-positions = ti.Vector.field(2, ti.f32, NV)
-old_positions = ti.Vector.field(2, ti.f32, NV)
+positions = ti.Vector.field(2, real, NV)
+old_positions = ti.Vector.field(2, real, NV)
 edge_indices = ti.Vector.field(2, ti.i32, NE)
 
-inv_mass =ti.field(ti.f32, NV)
-velocities = ti.Vector.field(2, ti.f32, NV)
+inv_mass =ti.field(real, NV)
+velocities = ti.Vector.field(2, real, NV)
 
-rest_len = ti.field(ti.f32, NE)
+rest_len = ti.field(real, NE)
+
+# edge indices grouped by color, edges of one color share no vertex
+color_order = ti.field(ti.i32, NE)
+use_coloring = args.solver == "colored_gs"
 
 @ti.kernel 
 def init_pos():
@@ -41,29 +63,62 @@ def init_rest_len():
         idx0, idx1  = edge_indices[i] 
         rest_len[i] = (positions[idx0] - positions[idx1]).norm()
 
+def init_from_scene():
+    # external mesh: topology and rest lengths come from the scene cache
+    positions.from_numpy(np.asarray(scene.positions))
+    old_positions.from_numpy(np.asarray(scene.positions))
+    edge_indices.from_numpy(np.asarray(scene.edges))
+    rest_len.from_numpy(np.asarray(scene.rest_len))
+    inv_mass.fill(1.0)
+
 @ti.kernel 
-def semi_euler(h: ti.f32):
+def semi_euler(h: real):
     gravity = ti.Vector([0.0, -0.8])
     for i in range(NV):
-        velocities[i] += h * gravity
-        old_positions[i] = positions[i]
-        positions[i] += h * velocities[i]
+        if inv_mass[i] != 0.0:
+            velocities[i] += h * gravity
+            old_positions[i] = positions[i]
+            positions[i] += h * velocities[i]
+
+@ti.kernel
+def compute_residual() -> real:
+    # dual residual before the iteration, the sweeps update in place
+    dual_residual = 0.0
+    for i in range(NE):
+        idx0, idx1  = edge_indices[i]
+        dual_residual += ((positions[idx0] - positions[idx1]).norm()
+                          - rest_len[i])**2
+    return dual_residual
+
+@ti.func
+def solve_edge(i):
+    idx0, idx1  = edge_indices[i] 
+    invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
+    dis = positions[idx0] - positions[idx1]
+    constraint = dis.norm() - rest_len[i]
+    gradient = dis.normalized()
+    l = -constraint / (invM0 + invM1)
+    if invM0 != 0.0:
+        positions[idx0] += invM0 * l * gradient
+    if invM1 != 0.0:
+        positions[idx1] -= invM1 * l * gradient
 
 @ti.kernel 
 def solve_constraints():
+    # all edges at once: concurrent writes to shared vertices race
     for i in range(NE):
-        idx0, idx1  = edge_indices[i] 
-        invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
-        dis = positions[idx0] - positions[idx1]
-        constraint = dis.norm() - rest_len[i]
-        gradient = dis.normalized()
-        l = -constraint / (invM0 + invM1)
-        if invM0 != 0.0:
-            positions[idx0] += invM0 * l * gradient
-        if invM1 != 0.0:
-            positions[idx1] -= invM1 * l * gradient
+        solve_edge(i)
+
+@ti.kernel
+def solve_constraints_colored(begin: ti.i32, end: ti.i32):
+    for k in range(begin, end):
+        solve_edge(color_order[k])
+
+def solve_colored():
+    for c in range(len(color_offsets) - 1):
+        solve_constraints_colored(color_offsets[c], color_offsets[c + 1])
 @ti.kernel
-def update_v(h: ti.f32):
+def update_v(h: real):
     for i in range(NV):
         velocities[i] = (positions[i] - old_positions[i])/h
 
@@ -74,19 +129,68 @@ def collision():
             positions[i][1] = 0.0
 
 def update(h, maxIte):
+    recorder.new_frame()
     semi_euler(h)
+    if contacts is not None:
+        contacts.find_pairs()
+    control.new_frame()
     for i in range(maxIte):
-        solve_constraints()
+        dual_residual = compute_residual()
+        if use_coloring:
+            solve_colored()
+        else:
+            solve_constraints()
+        if contacts is not None:
+            contacts.solve()
         collision()
+        recorder.record(i, dual_residual)
+        if control.done(i, dual_residual):
+            break
+    control.end_frame()
     update_v(h)
 
-init_pos()
-init_edge()
-init_rest_len()
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h, maxIte)
+    return control.total - total
+
+h = args.h
+maxIte = args.max_ite
+recorder = ResidualRecorder(args.residual_log or "data/Mesh_GS.bin",
+                            args.solver, squared=True)
+control = IterationController.from_args(args, squared=True)
+cache.prewarm(globals())
+if scene is None:
+    init_pos()
+    init_edge()
+    init_rest_len()
+else:
+    init_from_scene()
+if args.pin:
+    for i in pinned:
+        inv_mass[i] = 0.0
+state = dict(positions=positions, old_positions=old_positions,
+             velocities=velocities, inv_mass=inv_mass, rest_len=rest_len,
+             edge_indices=edge_indices)
+restore(args, state)
+contacts = None
+if args.self_collision:
+    contacts = SelfCollision(positions, inv_mass, edge_indices, rest_len,
+                             args.thickness)
+order, color_offsets = color_edges(edge_indices.to_numpy(), NV)
+color_order.from_numpy(order)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(positions, edge_indices, rest_len),
+                 stats=[contacts.stats if contacts is not None else None,
+                        control.stats, cache.stats],
+                 reset=control.reset, N=N, mesh=args.mesh, NE=NE)
+    checkpoint(args, state)
+    raise SystemExit
+
 gui = ti.GUI("Diplay tri mesh", res=(600,600))
+renderer = MeshRenderer(gui, positions, edge_indices)
 pause = False
-h = 0.01
-maxIte = 10
 while gui.running:
     gui.get_event(ti.GUI.PRESS)
     if gui.is_pressed(ti.GUI.ESCAPE):
@@ -97,13 +201,6 @@ while gui.running:
     if not pause:
         update(h, maxIte)
 
-    poses = positions.to_numpy()
-    edges = edge_indices.to_numpy()
-    begin_line, end_line = [], []
-    for i in range(edges.shape[0]):
-        idx0, idx1 = edges[i]
-        begin_line.append(poses[idx0])
-        end_line.append(poses[idx1])
-    gui.lines(np.asarray(begin_line), np.asarray(end_line), radius=2, color=0x0000FF) 
-    gui.circles(positions.to_numpy(), radius=6, color=0xffaa33)
-    gui.show()
\ No newline at end of file
+    renderer.draw()
+    gui.show()
+checkpoint(args, state)
@@ -1,22 +1,65 @@
 import taichi as ti
 import numpy as np 
+from mesh_render import MeshRenderer
+from headless import (make_parser, run_headless, edge_residual, real_type,
+                      real_numpy_type)
+from residual_log import ResidualRecorder, DeviceResidualHistory
+from scenes import load_mesh, top_corners
+from profiling import Profiler
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+from self_collision import SelfCollision
+from controller import IterationController
 
-ti.init(arch=ti.gpu)
+parser = make_parser(N=5, h=0.01, max_ite=20, solvers=("jacobi", "anderson"),
+                     arch="gpu", history=True, mesh=True, fuse=True,
+                     control=True, profile=True, self_collision=True,
+                     xpbd=True)
+parser.add_argument("--anderson-m", type=int, default=5,
+                    help="Anderson history window")
+args = parser.parse_args()
+if args.solver == "anderson" and args.fuse != "none":
+    parser.error("--solver anderson mixes on the host, use --fuse none")
+if args.self_collision and args.fuse != "none":
+    parser.error("--self-collision runs its own kernels, use --fuse none")
+if args.compliance is not None and args.solver != "jacobi":
+    parser.error("--compliance accumulates multipliers, use --solver jacobi")
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+profiler = Profiler.from_args(args)
 
-N = 5
-NV = (N+1)**2
-NE = (N+1) * N * 2
-positions = ti.Vector.field(2, ti.f32, NV)
-old_positions = ti.Vector.field(2, ti.f32, NV)
+N = args.N
+scene = load_mesh(args.mesh) if args.mesh else None
+NV = (N+1)**2 if scene is None else len(scene.positions)
+NE = (N+1) * N * 2 if scene is None else len(scene.edges)
+pinned = [N, NV-1] if scene is None else top_corners(scene.positions)
+positions = ti.Vector.field(2, real, NV)
+old_positions = ti.Vector.field(2, real, NV)
 edge_indices = ti.Vector.field(2, ti.i32, NE)
 
-inv_mass =ti.field(ti.f32, NV)
-velocities = ti.Vector.field(2, ti.f32, NV)
+inv_mass =ti.field(real, NV)
+velocities = ti.Vector.field(2, real, NV)
 
-rest_len = ti.field(ti.f32, NE)
+rest_len = ti.field(real, NE)
 
-constraint = ti.field(ti.f32, NE)
-gradient = ti.Vector.field(2, ti.f32, 2 * NE)
+constraint = ti.field(real, NE)
+gradient = ti.Vector.field(2, real, 2 * NE)
+# squared dual residual of every iteration of the last K frames
+residual_history = ti.field(real, (max(args.residual_every, 1), args.max_ite))
+# XPBD, see --compliance: compliance / h^2 and accumulated multiplier per edge
+xpbd = args.compliance is not None
+compliance = ti.field(real, NE)
+multiplier = ti.field(real, NE)
+warm_dir = ti.Vector.field(2, real, NE)  # multiplier times direction
+# Jacobi relaxation of XPBD, divided by the edge count of the busier vertex:
+# the multipliers add up every overlapping correction, with the plain 0.9
+# they overshoot and the warm start rings
+relax = ti.field(real, NE)
+anderson = None
+if args.solver == "anderson":
+    from anderson import Anderson
+    anderson = Anderson(positions, args.anderson_m)
 
 @ti.kernel 
 def init_pos():
@@ -45,62 +88,252 @@ def init_rest_len():
         idx0, idx1  = edge_indices[i] 
         rest_len[i] = (positions[idx0] - positions[idx1]).norm()
 
-@ti.kernel 
-def semi_euler(h: ti.f32):
+def init_from_scene():
+    # external mesh: topology and rest lengths come from the scene cache
+    positions.from_numpy(np.asarray(scene.positions))
+    old_positions.from_numpy(np.asarray(scene.positions))
+    edge_indices.from_numpy(np.asarray(scene.edges))
+    rest_len.from_numpy(np.asarray(scene.rest_len))
+    mass = np.ones(NV, np.float32)
+    mass[pinned] = 0.0
+    inv_mass.from_numpy(mass)
+
+@ti.func
+def semi_euler_vertex(i, h):
     gravity = ti.Vector([0.0, -0.8])
+    if inv_mass[i] != 0.0:
+        velocities[i] += h * gravity
+        old_positions[i] = positions[i]
+        positions[i] += h * velocities[i]
+
+@ti.kernel 
+def semi_euler(h: real):
     for i in range(NV):
-        if inv_mass[i] != 0.0:
-            velocities[i] += h * gravity
-            old_positions[i] = positions[i]
-            positions[i] += h * velocities[i]
+        semi_euler_vertex(i, h)
+
+@ti.func
+def eval_constraint(i):
+    idx0, idx1  = edge_indices[i] 
+    dis = positions[idx0] - positions[idx1]
+    constraint[i] = dis.norm() - rest_len[i]
+    if ti.static(xpbd):
+        # the XPBD residual C + alpha / h^2 * lambda
+        constraint[i] += compliance[i] * multiplier[i]
+    gradient[2 * i + 0] = dis.normalized()
+    gradient[2 * i + 1] = -dis.normalized()
+    return constraint[i]**2
 
 @ti.kernel
-def compute_constraint_gradient():
+def compute_constraint_gradient() -> real:
+    dual_residual = 0.0
     for i in range(NE):
-        idx0, idx1  = edge_indices[i] 
-        dis = positions[idx0] - positions[idx1]
-        constraint[i] = dis.norm() - rest_len[i]
-        gradient[2 * i + 0] = dis.normalized()
-        gradient[2 * i + 1] = -dis.normalized()
+        dual_residual += eval_constraint(i)
+    return dual_residual
+
+@ti.kernel
+def compute_constraint_gradient_history(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(NE):
+        dual_residual += eval_constraint(i)
+    residual_history[slot, ite] = dual_residual
+
+def evaluate_constraints(ite):
+    if history is None:
+        return compute_constraint_gradient()
+    # no return value, the iteration loop does not wait for the device
+    compute_constraint_gradient_history(history.slot, ite)
+    return None
+
+@ti.func
+def solve_edge(i):
+    idx0, idx1  = edge_indices[i] 
+    invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
+    w, r = invM0 + invM1, 0.9
+    if ti.static(xpbd):
+        w += compliance[i]
+        r = relax[i]
+    l = -constraint[i] / w
+    if ti.static(xpbd):
+        multiplier[i] += r * l
+    if invM0 != 0.0:
+        positions[idx0] += r * invM0 * l * gradient[2 * i + 0]
+    if invM1 != 0.0:
+        positions[idx1] += r * invM1 * l * gradient[2 * i + 1]
+
+@ti.func
+def warm_start_direction(i):
+    # start from the last frame's multipliers: move the predicted positions
+    # by the correction M^-1 grad C^T lambda they stand for, with every
+    # direction taken before any position moves
+    multiplier[i] *= ti.static(args.warm_start)
+    idx0, idx1  = edge_indices[i]
+    warm_dir[i] = multiplier[i] * (positions[idx0] - positions[idx1]).normalized()
+
+@ti.func
+def warm_start_edge(i):
+    idx0, idx1  = edge_indices[i]
+    positions[idx0] += inv_mass[idx0] * warm_dir[i]
+    positions[idx1] -= inv_mass[idx1] * warm_dir[i]
+
+@ti.kernel
+def warm_start():
+    for i in range(NE):
+        warm_start_direction(i)
+    for i in range(NE):
+        warm_start_edge(i)
 
 @ti.kernel 
 def solve_constraints():
     for i in range(NE):
-        idx0, idx1  = edge_indices[i] 
-        invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
-        l = -constraint[i] / (invM0 + invM1)
-        if invM0 != 0.0:
-            positions[idx0] += 0.9 * invM0 * l * gradient[2 * i + 0]
-        if invM1 != 0.0:
-            positions[idx1] += 0.9 * invM1 * l * gradient[2 * i + 1]
+        solve_edge(i)
+
+@ti.func
+def update_v_vertex(i, h):
+    if inv_mass[i] != 0.0:
+        velocities[i] = (positions[i] - old_positions[i])/h
 
 @ti.kernel
-def update_v(h: ti.f32):
+def update_v(h: real):
     for i in range(NV):
-        if inv_mass[i] != 0.0:
-            velocities[i] = (positions[i] - old_positions[i])/h
+        update_v_vertex(i, h)
+
+@ti.func
+def collide(i):
+    if positions[i][1] < 0.0:
+        positions[i][1] = 0.0
 
 @ti.kernel 
 def collision():
     for i in range(NV):
-        if positions[i][1] < 0.0:
-            positions[i][1] = 0.0
+        collide(i)
 
+@ti.kernel
+def fused_iteration(slot: ti.i32, ite: ti.i32):
+    # one launch per iteration, the top-level loops run one after the other
+    dual_residual = 0.0
+    for i in range(NE):
+        dual_residual += eval_constraint(i)
+    residual_history[slot, ite] = dual_residual
+    for i in range(NE):
+        solve_edge(i)
+    for i in range(NV):
+        collide(i)
+
+@ti.kernel
+def fused_frame(h: real, maxIte: ti.i32, slot: ti.i32):
+    # one launch per frame, serialized by the single outer iteration
+    for _ in range(1):
+        for i in range(NV):
+            semi_euler_vertex(i, h)
+        if ti.static(xpbd):
+            for i in range(NE):
+                warm_start_direction(i)
+            for i in range(NE):
+                warm_start_edge(i)
+        for ite in range(maxIte):
+            dual_residual = 0.0
+            for i in range(NE):
+                dual_residual += eval_constraint(i)
+            residual_history[slot, ite] = dual_residual
+            for i in range(NE):
+                solve_edge(i)
+            for i in range(NV):
+                collide(i)
+        for i in range(NV):
+            update_v_vertex(i, h)
+
+@profiler.frame
 def update(h, maxIte):
+    recorder.new_frame()
+    if args.fuse == "frame":
+        fused_frame(h, maxIte, history.slot)
+        history.end_frame(control.end_frame(maxIte))
+        return
     semi_euler(h)
+    if xpbd:
+        warm_start()
+    if contacts is not None:
+        contacts.find_pairs()
+    if anderson is not None:
+        anderson.new_frame()
+    control.new_frame()
     for i in range(maxIte):
-        compute_constraint_gradient()
-        solve_constraints()
-        collision()
+        dual_residual = None
+        if args.fuse == "iteration":
+            fused_iteration(history.slot, i)
+        elif anderson is not None:
+            anderson.begin()
+            dual_residual = evaluate_constraints(i)
+            solve_constraints()
+            if contacts is not None:
+                contacts.solve()
+            with profiler.phase("anderson_mix"):
+                anderson.mix()
+            collision()
+        else:
+            dual_residual = evaluate_constraints(i)
+            solve_constraints()
+            if contacts is not None:
+                contacts.solve()
+            collision()
+        if history is None:
+            recorder.record(i, dual_residual)
+        if control.done(i, dual_residual):
+            break
+    iterations = control.end_frame()
     update_v(h)
+    if history is not None:
+        history.end_frame(iterations)
+
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h, maxIte)
+    return control.total - total
+
+h = args.h
+maxIte = args.max_ite
+recorder = ResidualRecorder(args.residual_log or "data/Mesh_Jacobi.bin",
+                            args.solver, squared=True)
+recorder.flush = profiler.timed("residual_io")(recorder.flush)
+history = None
+if args.residual_every > 0 or args.fuse != "none":
+    history = DeviceResidualHistory(residual_history, recorder)
+control = IterationController.from_args(args, squared=True)
+cache.prewarm(globals())
+profiler.wrap_kernels(globals())
+if scene is None:
+    init_pos()
+    init_edge()
+    init_rest_len()
+else:
+    init_from_scene()
+if xpbd:
+    compliance.fill(args.compliance / h**2)
+    e = edge_indices.to_numpy()
+    valence = np.bincount(e.ravel(), minlength=NV)
+    busier = np.maximum(valence[e[:, 0]], valence[e[:, 1]])
+    relax.from_numpy((0.9 / busier).astype(real_numpy_type(args)))
+state = dict(positions=positions, old_positions=old_positions,
+             velocities=velocities, inv_mass=inv_mass, rest_len=rest_len,
+             edge_indices=edge_indices)
+restore(args, state)
+contacts = None
+if args.self_collision:
+    contacts = SelfCollision(positions, inv_mass, edge_indices, rest_len,
+                             args.thickness)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(positions, edge_indices, rest_len),
+                 stats=[anderson.stats if anderson is not None else None,
+                        contacts.stats if contacts is not None else None,
+                        control.stats, cache.stats],
+                 reset=control.reset, N=N, mesh=args.mesh, NE=NE)
+    checkpoint(args, state)
+    raise SystemExit
 
-init_pos()
-init_edge()
-init_rest_len()
 gui = ti.GUI("Diplay tri mesh", res=(600,600))
+renderer = MeshRenderer(gui, positions, edge_indices)
 pause = False
-h = 0.01
-maxIte = 20
 while gui.running:
     gui.get_event(ti.GUI.PRESS)
     if gui.is_pressed(ti.GUI.ESCAPE):
@@ -111,15 +344,9 @@ while gui.running:
     if not pause:
         update(h, maxIte)
 
-    poses = positions.to_numpy()
-    edges = edge_indices.to_numpy()
-    begin_line, end_line = [], []
-    for i in range(edges.shape[0]):
-        idx0, idx1 = edges[i]
-        begin_line.append(poses[idx0])
-        end_line.append(poses[idx1])
-    gui.lines(np.asarray(begin_line), np.asarray(end_line), radius=2, color=0x0000FF) 
-    gui.circles(positions.to_numpy(), radius=6, color=0xffaa33)
-    static_points = np.array([poses[N], poses[NV-1]])
-    gui.circles(static_points, radius=7, color=0xff0000)
-    gui.show()
\ No newline at end of file
+    with profiler.phase("render"):
+        poses = renderer.draw()
+        static_points = poses[pinned]
+        gui.circles(static_points, radius=7, color=0xff0000)
+        gui.show()
+checkpoint(args, state)
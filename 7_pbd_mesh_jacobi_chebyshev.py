@@ -1,25 +1,58 @@
 import taichi as ti
 import numpy as np 
+from mesh_render import MeshRenderer
+from headless import (make_parser, run_headless, edge_residual, real_type,
+                      real_numpy_type)
+from residual_log import ResidualRecorder, DeviceResidualHistory
+from scenes import load_mesh, top_corners
+from chebyshev import ChebyshevAccelerator
+from controller import IterationController
+from profiling import Profiler
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+from self_collision import SelfCollision
 
-ti.init(arch=ti.gpu)
+parser = make_parser(N=5, h=0.01, max_ite=200, solvers=("jacobi", "chebyshev"),
+                     arch="gpu", history=True, mesh=True, fuse=True,
+                     control=True, profile=True, self_collision=True)
+parser.add_argument("--rho", type=float,
+                    help="fixed spectral radius (default: estimated online)")
+parser.add_argument("--cheb-warmup", type=int, default=10,
+                    help="plain Jacobi iterations before the acceleration")
+args = parser.parse_args()
+if args.self_collision and args.fuse != "none":
+    parser.error("--self-collision runs its own kernels, use --fuse none")
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+profiler = Profiler.from_args(args)
 
-N = 5
-NV = (N+1)**2
-NE = (N+1) * N * 2
-positions = ti.Vector.field(2, ti.f32, NV)
-old_positions = ti.Vector.field(2, ti.f32, NV)
-pre_positions = ti.Vector.field(2, ti.f32, NV)
+N = args.N
+scene = load_mesh(args.mesh) if args.mesh else None
+NV = (N+1)**2 if scene is None else len(scene.positions)
+NE = (N+1) * N * 2 if scene is None else len(scene.edges)
+pinned = [N, NV-1] if scene is None else top_corners(scene.positions)
+positions = ti.Vector.field(2, real, NV)
+old_positions = ti.Vector.field(2, real, NV)
+pre_positions = ti.Vector.field(2, real, NV)
+prev_positions = ti.Vector.field(2, real, NV)  # Chebyshev x_{k-1}
 edge_indices = ti.Vector.field(2, ti.i32, NE)
 
-inv_mass =ti.field(ti.f32, NV)
-velocities = ti.Vector.field(2, ti.f32, NV)
+inv_mass =ti.field(real, NV)
+velocities = ti.Vector.field(2, real, NV)
 
-rest_len = ti.field(ti.f32, NE)
+rest_len = ti.field(real, NE)
 
-constraint = ti.field(ti.f32, NE)
-gradient = ti.Vector.field(2, ti.f32, 2 * NE)
-
-rho = 0.0
+constraint = ti.field(real, NE)
+gradient = ti.Vector.field(2, real, 2 * NE)
+# squared dual residual of every iteration of the last K frames
+residual_history = ti.field(real, (max(args.residual_every, 1), args.max_ite))
+omega_schedule = ti.field(real, args.max_ite)  # Chebyshev weights, fused frames
+# device-side divergence guard for the frames run with precomputed weights
+cheb = ChebyshevAccelerator(args.cheb_warmup, args.rho,
+                            dtype=real_numpy_type(args))
+cheb_best = ti.field(real, ())
+cheb_diverged = ti.field(ti.i32, ())
 
 @ti.kernel 
 def init_pos():
@@ -48,99 +81,265 @@ def init_rest_len():
         idx0, idx1  = edge_indices[i] 
         rest_len[i] = (positions[idx0] - positions[idx1]).norm()
 
-@ti.kernel 
-def semi_euler(h: ti.f32):
+def init_from_scene():
+    # external mesh: topology and rest lengths come from the scene cache
+    positions.from_numpy(np.asarray(scene.positions))
+    old_positions.from_numpy(np.asarray(scene.positions))
+    edge_indices.from_numpy(np.asarray(scene.edges))
+    rest_len.from_numpy(np.asarray(scene.rest_len))
+    mass = np.ones(NV, np.float32)
+    mass[pinned] = 0.0
+    inv_mass.from_numpy(mass)
+
+@ti.func
+def semi_euler_vertex(i, h):
     gravity = ti.Vector([0.0, -0.8])
+    if inv_mass[i] != 0.0:
+        velocities[i] += h * gravity
+        old_positions[i] = positions[i]
+        positions[i] += h * velocities[i]
+
+@ti.kernel 
+def semi_euler(h: real):
     for i in range(NV):
-        if inv_mass[i] != 0.0:
-            velocities[i] += h * gravity
-            old_positions[i] = positions[i]
-            positions[i] += h * velocities[i]
+        semi_euler_vertex(i, h)
+
+@ti.func
+def eval_constraint(i):
+    idx0, idx1  = edge_indices[i] 
+    dis = positions[idx0] - positions[idx1]
+    constraint[i] = dis.norm() - rest_len[i]
+    gradient[2 * i + 0] = dis.normalized()
+    gradient[2 * i + 1] = -dis.normalized()
+    return constraint[i]**2
 
 @ti.kernel
-def compute_constraint_gradient() -> ti.f32:
+def compute_constraint_gradient() -> real:
     dual_residual = 0.0
     for i in range(NE):
-        idx0, idx1  = edge_indices[i] 
-        dis = positions[idx0] - positions[idx1]
-        constraint[i] = dis.norm() - rest_len[i]
-        dual_residual += constraint[i]**2
-        gradient[2 * i + 0] = dis.normalized()
-        gradient[2 * i + 1] = -dis.normalized()
+        dual_residual += eval_constraint(i)
     return ti.sqrt(dual_residual)
 
+@ti.func
+def record_residual(slot, ite, dual_residual):
+    residual_history[slot, ite] = dual_residual
+    # squared residuals: plain Jacobi for the rest of the frame once they
+    # grow past the divergence ratio
+    if ite >= ti.static(cheb.warmup):
+        if dual_residual > ti.static(cheb.divergence**2) * cheb_best[None]:
+            cheb_diverged[None] = 1
+        cheb_best[None] = ti.min(cheb_best[None], dual_residual)
+
+@ti.func
+def reset_guard():
+    cheb_best[None] = 1e30
+    cheb_diverged[None] = 0
+
+@ti.kernel
+def reset_divergence_guard():
+    reset_guard()
+
+@ti.kernel
+def compute_constraint_gradient_history(slot: ti.i32, ite: ti.i32):
+    dual_residual = 0.0
+    for i in range(NE):
+        dual_residual += eval_constraint(i)
+    record_residual(slot, ite, dual_residual)
+
+@ti.func
+def solve_edge(i):
+    idx0, idx1  = edge_indices[i] 
+    invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
+    l = -constraint[i] / (invM0 + invM1)
+    if invM0 != 0.0:
+        positions[idx0] += invM0 * l * gradient[2 * i + 0]
+    if invM1 != 0.0:
+        positions[idx1] += invM1 * l * gradient[2 * i + 1]
+
 @ti.kernel 
 def solve_constraints():
     for i in range(NE):
-        idx0, idx1  = edge_indices[i] 
-        invM0, invM1 = inv_mass[idx0], inv_mass[idx1]
-        l = -constraint[i] / (invM0 + invM1)
-        if invM0 != 0.0:
-            positions[idx0] += invM0 * l * gradient[2 * i + 0]
-        if invM1 != 0.0:
-            positions[idx1] += invM1 * l * gradient[2 * i + 1]
+        solve_edge(i)
+
+@ti.func
+def update_v_vertex(i, h):
+    if inv_mass[i] != 0.0:
+        velocities[i] = (positions[i] - old_positions[i])/h
 
 @ti.kernel
-def update_v(h: ti.f32):
+def update_v(h: real):
     for i in range(NV):
-        if inv_mass[i] != 0.0:
-            velocities[i] = (positions[i] - old_positions[i])/h
+        update_v_vertex(i, h)
+
+@ti.func
+def collide(i):
+    if positions[i][1] < 0.0:
+        positions[i][1] = 0.0
 
 @ti.kernel 
 def collision():
     for i in range(NV):
-        if positions[i][1] < 0.0:
-            positions[i][1] = 0.0
+        collide(i)
 
 @ti.kernel
 def copy_positions():
     for i in range(NV):
         pre_positions[i] = positions[i]
 
+@ti.func
+def chebyshev_vertex(i, omega):
+    w = omega
+    if cheb_diverged[None]:
+        w = 1.0
+    positions[i] = prev_positions[i] + w * (positions[i] - prev_positions[i])
+    prev_positions[i] = pre_positions[i]
+
+@ti.kernel
+def apply_primal_chebyshev(omega: real):
+    for i in range(NV):
+        chebyshev_vertex(i, omega)
+
 @ti.kernel
-def apply_primal_chebyshev(omega: ti.f32):
+def fused_iteration(slot: ti.i32, ite: ti.i32, omega: real):
+    # one launch per iteration, the top-level loops run one after the other
+    for i in range(NV):
+        pre_positions[i] = positions[i]
+    dual_residual = 0.0
+    for i in range(NE):
+        dual_residual += eval_constraint(i)
+    record_residual(slot, ite, dual_residual)
+    for i in range(NE):
+        solve_edge(i)
+    if ti.static(use_primal_chebyshev):
+        for i in range(NV):
+            chebyshev_vertex(i, omega)
     for i in range(NV):
-        positions[i] *= omega
-        positions[i] += (1 - omega) * pre_positions[i]
-
-def apply_chebyshev(ite):
-    omega = 1
-    if ite <= 10:
-        omega = 1.0
-    elif ite == 11:
-        omega = 2/(2-rho * rho)
-    else:
-        omega = 4/(4-rho*rho*omega)
-    apply_primal_chebyshev(omega)
-    return omega 
+        collide(i)
 
+@ti.kernel
+def fused_frame(h: real, maxIte: ti.i32, slot: ti.i32):
+    # one launch per frame, serialized by the single outer iteration
+    for _ in range(1):
+        reset_guard()
+        for i in range(NV):
+            semi_euler_vertex(i, h)
+        for ite in range(maxIte):
+            for i in range(NV):
+                pre_positions[i] = positions[i]
+            dual_residual = 0.0
+            for i in range(NE):
+                dual_residual += eval_constraint(i)
+            record_residual(slot, ite, dual_residual)
+            for i in range(NE):
+                solve_edge(i)
+            if ti.static(use_primal_chebyshev):
+                for i in range(NV):
+                    chebyshev_vertex(i, omega_schedule[ite])
+            for i in range(NV):
+                collide(i)
+        for i in range(NV):
+            update_v_vertex(i, h)
+
+@profiler.frame
 def update(h, maxIte, use_primal_chebyshev):
+    recorder.new_frame()
+    if args.fuse == "frame":
+        fused_frame(h, maxIte, history.slot)
+        end_frame(control.end_frame(maxIte))
+        return
     semi_euler(h)
+    if contacts is not None:
+        contacts.find_pairs()
+    cheb.new_frame()
+    if history is not None and use_primal_chebyshev:
+        reset_divergence_guard()
     dual_residual = [None] * maxIte
+    control.new_frame()
     for ite in range(maxIte):
-        copy_positions()
-        dual_residual[ite] = compute_constraint_gradient()
-        solve_constraints()
-        if use_primal_chebyshev:
-            apply_chebyshev(ite)
-        collision()
+        if args.fuse == "iteration":
+            fused_iteration(history.slot, ite, omegas[ite])
+        else:
+            copy_positions()
+            if history is None:
+                dual_residual[ite] = compute_constraint_gradient()
+                recorder.record(ite, dual_residual[ite])
+            else:
+                compute_constraint_gradient_history(history.slot, ite)
+            solve_constraints()
+            if contacts is not None:
+                contacts.solve()
+            if use_primal_chebyshev:
+                # residuals on the device: omegas from the last read-back frames
+                omega = (omegas[ite] if history is not None
+                         else cheb.step(dual_residual[ite]))
+                apply_primal_chebyshev(omega)
+            collision()
+        if control.done(ite, dual_residual[ite]):
+            break
+    iterations = control.end_frame()
     update_v(h)
-    return dual_residual
+    if history is not None:
+        end_frame(iterations)
 
-init_pos()
-init_edge()
-init_rest_len()
-gui = ti.GUI("Diplay tri mesh", res=(600,600))
-pause = False
-h = 0.01
-maxIte = 200
+def end_frame(iterations):
+    global omegas
+    frame = history.frame
+    history.end_frame(iterations)
+    if use_primal_chebyshev and history.frame != frame:
+        cheb.observe(history.last)
+        omegas = cheb.schedule(maxIte)
+        omega_schedule.from_numpy(omegas)
+
+def step(n_frames=1):
+    total = control.total
+    for _ in range(n_frames):
+        update(h, maxIte, use_primal_chebyshev)
+    return control.total - total
 
-use_primal_chebyshev = False
-dual_residual_file = "data/dual_residual.txt"
+h = args.h
+maxIte = args.max_ite
+use_primal_chebyshev = args.solver == "chebyshev"
+dual_residual_file = "data/dual_residual.bin"
 if use_primal_chebyshev:
-    dual_residual_file = "data/chebyshev_dual_residual.txt"
-residual_file = open(dual_residual_file, "w")
+    dual_residual_file = "data/chebyshev_dual_residual.bin"
+recorder = ResidualRecorder(args.residual_log or dual_residual_file,
+                            args.solver)
+recorder.flush = profiler.timed("residual_io")(recorder.flush)
+history = None
+if args.residual_every > 0 or args.fuse != "none":
+    history = DeviceResidualHistory(residual_history, recorder,
+                                    transform=np.sqrt)
+omegas = cheb.schedule(maxIte)
+omega_schedule.from_numpy(omegas)
+control = IterationController.from_args(args)
+cache.prewarm(globals())
+profiler.wrap_kernels(globals())
+if scene is None:
+    init_pos()
+    init_edge()
+    init_rest_len()
+else:
+    init_from_scene()
+state = dict(positions=positions, old_positions=old_positions,
+             velocities=velocities, inv_mass=inv_mass, rest_len=rest_len,
+             edge_indices=edge_indices)
+restore(args, state)
+contacts = None
+if args.self_collision:
+    contacts = SelfCollision(positions, inv_mass, edge_indices, rest_len,
+                             args.thickness)
+if args.headless:
+    run_headless(args, step, lambda: edge_residual(positions, edge_indices, rest_len),
+                 stats=[cheb.stats if use_primal_chebyshev else None,
+                        contacts.stats if contacts is not None else None,
+                        control.stats, cache.stats],
+                 reset=control.reset, N=N, mesh=args.mesh, NE=NE)
+    checkpoint(args, state)
+    raise SystemExit
 
+gui = ti.GUI("Diplay tri mesh", res=(600,600))
+renderer = MeshRenderer(gui, positions, edge_indices)
+pause = False
 frame = 0
 while gui.running:
     gui.get_event(ti.GUI.PRESS)
@@ -150,24 +349,14 @@ while gui.running:
         pause = not pause
     
     if not pause:
-        dual_residual = update(h, maxIte, use_primal_chebyshev)
-        for i in range(len(dual_residual)):
-                residual_file.write(f"{dual_residual[i]} \n")
-
-    poses = positions.to_numpy()
-    edges = edge_indices.to_numpy()
-    begin_line, end_line = [], []
-    for i in range(edges.shape[0]):
-        idx0, idx1 = edges[i]
-        begin_line.append(poses[idx0])
-        end_line.append(poses[idx1])
-    gui.lines(np.asarray(begin_line), np.asarray(end_line), radius=2, color=0x0000FF) 
-    gui.circles(positions.to_numpy(), radius=6, color=0xffaa33)
-    static_points = np.array([poses[N], poses[NV-1]])
-    gui.circles(static_points, radius=7, color=0xff0000)
-    gui.show()
+        update(h, maxIte, use_primal_chebyshev)
+
+    with profiler.phase("render"):
+        poses = renderer.draw()
+        static_points = poses[pinned]
+        gui.circles(static_points, radius=7, color=0xff0000)
+        gui.show()
     frame += 1
     # if frame == 5:
     #     gui.running = False
-
-residual_file.close()
\ No newline at end of file
+checkpoint(args, state)
@@ -0,0 +1,239 @@
+"""
+Batched Jacobi PBD: B independent rods (as in 2_1) or cloths (as in 6)
+in one set of fields with a leading batch dimension. Every instance has
+its own time step, iteration count, relaxation factor and pinned
+particles; one kernel launch advances all of them by a frame, running the
+instances in parallel and each instance's iterations in order.
+
+    python 8_pbd_batched_jacobi.py --scene cloth --batch 4096 --headless \
+        --h-range 0.005 0.02 --ite-range 5 50 --pins corners top_row \
+        --out study.npz
+"""
+import numpy as np
+import taichi as ti
+from headless import make_parser, run_headless, real_type, real_numpy_type
+from scenes import rod, grid, top_corners
+from compile_cache import CompileCache
+from checkpoint import restore, checkpoint
+
+PINS = {
+    "rod": ("first", "ends", "middle"),
+    "cloth": ("corners", "top_row", "left_corner"),
+}
+
+parser = make_parser(__doc__, n=10, N=5, h=0.01, max_ite=100,
+                     solvers=("jacobi",), arch="gpu")
+parser.add_argument("--scene", choices=tuple(PINS), default="rod")
+parser.add_argument("--batch", type=int, default=1024,
+                    help="number of independent instances")
+parser.add_argument("--relax", type=float,
+                    help="relaxation factor (default 0.8 rod, 0.9 cloth)")
+parser.add_argument("--h-range", type=float, nargs=2, metavar=("LO", "HI"),
+                    help="time steps spread evenly over the batch")
+parser.add_argument("--ite-range", type=int, nargs=2, metavar=("LO", "HI"),
+                    help="iteration counts spread evenly over the batch")
+parser.add_argument("--relax-range", type=float, nargs=2,
+                    metavar=("LO", "HI"),
+                    help="relaxation factors spread evenly over the batch")
+parser.add_argument("--pins", nargs="+", metavar="PATTERN",
+                    help="pinning patterns the instances cycle through: "
+                         "rod: first, ends, middle; "
+                         "cloth: corners, top_row, left_corner")
+parser.add_argument("--show", type=int, default=16,
+                    help="instances drawn in the GUI")
+parser.add_argument("--out", help="save parameters, residuals and "
+                                  "positions of every instance (.npz)")
+args = parser.parse_args()
+pins = args.pins or [PINS[args.scene][0]]
+for p in pins:
+    if p not in PINS[args.scene]:
+        parser.error(f"unknown {args.scene} pinning pattern {p}")
+real = real_type(args)
+cache = CompileCache.from_args(args, __file__)
+cache.init(default_fp=real)
+
+cloth = args.scene == "cloth"
+scene = grid(args.N) if cloth else rod(args.n)
+B = args.batch
+NP, NE = len(scene.positions), len(scene.edges)
+gravity = -0.8 if cloth else -9.8
+
+# per-instance state, shared topology
+pos = ti.Vector.field(2, real, (B, NP))
+old_pos = ti.Vector.field(2, real, (B, NP))
+vel = ti.Vector.field(2, real, (B, NP))
+inv_mass = ti.field(real, (B, NP))
+constraint = ti.field(real, (B, NE))
+gradient = ti.Vector.field(2, real, (B, NE))
+edge = ti.Vector.field(2, ti.i32, NE)
+rest_len = ti.field(real, NE)
+# per-instance parameters
+h_b = ti.field(real, B)
+ite_b = ti.field(ti.i32, B)
+relax_b = ti.field(real, B)
+residual = ti.field(real, B)
+
+
+def spread(value_range, default, dtype):
+    if value_range is None:
+        return np.full(B, default, dtype)
+    values = np.linspace(value_range[0], value_range[1], B)
+    return (np.rint(values) if dtype == np.int32 else values).astype(dtype)
+
+
+def pinned(pattern):
+    if pattern == "first":
+        return [0]
+    if pattern == "ends":
+        return [0, NP - 1]
+    if pattern == "middle":
+        return [NP // 2]
+    corners = top_corners(scene.positions)
+    if pattern == "corners":
+        return corners
+    if pattern == "left_corner":
+        return corners[:1]
+    top = scene.positions[:, 1].max()  # top_row
+    return list(np.flatnonzero(np.isclose(scene.positions[:, 1], top)))
+
+
+def init():
+    positions = np.broadcast_to(scene.positions, (B, NP, 2))
+    pos.from_numpy(np.ascontiguousarray(positions))
+    old_pos.from_numpy(np.ascontiguousarray(positions))
+    vel.fill(0.0)
+    edge.from_numpy(scene.edges)
+    rest_len.from_numpy(scene.rest_len)
+    mass = np.ones((B, NP), np.float32)
+    for b in range(len(pins)):
+        mass[b::len(pins), pinned(pins[b])] = 0.0
+    inv_mass.from_numpy(mass)
+    # the parameters are saved in f64, the fields hold --precision
+    h_b.from_numpy(params["h"].astype(real_numpy_type(args)))
+    ite_b.from_numpy(params["max_ite"])
+    relax_b.from_numpy(params["relax"].astype(real_numpy_type(args)))
+
+
+@ti.func
+def semi_euler_particle(b, i, h):
+    if inv_mass[b, i] != 0.0:
+        vel[b, i] += h * ti.Vector([0.0, gravity])
+        old_pos[b, i] = pos[b, i]
+        pos[b, i] += h * vel[b, i]
+
+
+@ti.func
+def eval_constraint(b, e):
+    idx0, idx1 = edge[e]
+    dis = pos[b, idx0] - pos[b, idx1]
+    constraint[b, e] = dis.norm() - rest_len[e]
+    gradient[b, e] = dis.normalized()
+
+
+@ti.func
+def solve_edge(b, e):
+    idx0, idx1 = edge[e]
+    invM0, invM1 = inv_mass[b, idx0], inv_mass[b, idx1]
+    if invM0 + invM1 != 0.0:
+        l = -relax_b[b] * constraint[b, e] / (invM0 + invM1)
+        pos[b, idx0] += invM0 * l * gradient[b, e]
+        pos[b, idx1] -= invM1 * l * gradient[b, e]
+
+
+@ti.func
+def update_vel_particle(b, i, h):
+    if inv_mass[b, i] != 0.0:
+        vel[b, i] = (pos[b, i] - old_pos[b, i]) / h
+
+
+@ti.kernel
+def step_frame():
+    # instances in parallel; everything inside an instance runs in order,
+    # so the constraint pass finishes before the Jacobi update as in 2_1/6
+    for b in range(B):
+        h = h_b[b]
+        for i in range(NP):
+            semi_euler_particle(b, i, h)
+        for ite in range(ite_b[b]):
+            for e in range(NE):
+                eval_constraint(b, e)
+            for e in range(NE):
+                solve_edge(b, e)
+            if ti.static(cloth):
+                for i in range(NP):
+                    if pos[b, i][1] < 0.0:
+                        pos[b, i][1] = 0.0
+        for i in range(NP):
+            update_vel_particle(b, i, h)
+
+
+@ti.kernel
+def compute_residuals():
+    for b in range(B):
+        r = 0.0
+        for e in range(NE):
+            idx0, idx1 = edge[e]
+            c = (pos[b, idx0] - pos[b, idx1]).norm() - rest_len[e]
+            r += c * c
+        residual[b] = ti.sqrt(r)
+
+
+def step(n_frames=1):
+    for _ in range(n_frames):
+        step_frame()
+    return n_frames * int(params["max_ite"].sum())
+
+
+def residuals():
+    compute_residuals()
+    return residual.to_numpy()
+
+
+params = {
+    "h": spread(args.h_range, args.h, np.float64),
+    "max_ite": spread(args.ite_range, args.max_ite, np.int32),
+    "relax": spread(args.relax_range,
+                    args.relax or (0.9 if cloth else 0.8), np.float64),
+    "pins": np.array([pins[b % len(pins)] for b in range(B)]),
+}
+cache.prewarm(globals())
+init()
+# the physical state only, the per-instance parameters come from the options
+state = dict(pos=pos, old_pos=old_pos, vel=vel, inv_mass=inv_mass,
+             rest_len=rest_len, edge=edge)
+restore(args, state)
+if args.headless:
+    run_headless(args, step, lambda: float(residuals().max()),
+                 stats=cache.stats, scene=args.scene, batch=B,
+                 particles=NP, NE=NE)
+    if args.out:
+        np.savez(args.out, residual=residuals(), positions=pos.to_numpy(),
+                 **params)
+    checkpoint(args, state)
+    raise SystemExit
+
+show = min(args.show, B)
+cols = int(np.ceil(np.sqrt(show)))
+gui = ti.GUI(f"{B} batched {args.scene}s", res=(800, 800))
+pause = False
+while gui.running:
+    gui.get_event(ti.GUI.PRESS)
+    if gui.is_pressed(ti.GUI.ESCAPE):
+        gui.running = False
+    elif gui.is_pressed(ti.GUI.SPACE):
+        pause = not pause
+
+    if not pause:
+        step_frame()
+
+    poses = pos.to_numpy()[:show]
+    edges = scene.edges
+    for b in range(show):
+        offset = np.array([b % cols, cols - 1 - b // cols]) / cols
+        x = poses[b] / cols + offset
+        gui.lines(x[edges[:, 0]], x[edges[:, 1]], radius=1, color=0x0000FF)
+    gui.show()
+if args.out:
+    np.savez(args.out, residual=residuals(), positions=pos.to_numpy(),
+             **params)
+checkpoint(args, state)
@@ -0,0 +1,307 @@
+"""
+Algebraic multigrid backends for AMGX_solve in 2_4_pbd_rod_real_amgx.py.
+
+Both backends take the AMGX config dict and expose the same interface:
+
+    amg = make_backend(cfg, "auto")   # "amgx", "cpu" or "auto"
+    amg.setup(A)                      # A: scipy CSR matrix
+    x = amg.solve(b)
+    amg.resetup(A)                    # new values, same aggregates
+    amg.set_matrix(A)                 # new fine level values only
+    amg.destroy()
+
+"amgx" wraps pyamgx and needs a CUDA device. "cpu" is a pure NumPy/SciPy
+aggregation AMG that reads the same keys: presweeps, postsweeps, max_levels,
+selector, tolerance, max_iters, convergence, monitor_residual, cycle,
+smoother, relaxation_factor, min_coarse_rows and dense_lu_num_rows.
+"auto" picks "amgx" when pyamgx can be imported and "cpu" otherwise.
+
+CachedHierarchy decides per solve how much of the setup to redo,
+bench_amg_reuse.py measures what each policy saves.
+"""
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
+
+
+def _solver_cfg(cfg):
+    return cfg.get("solver", cfg)
+
+
+def pairwise_aggregate(A):
+    """
+    Greedy pairwise matching: every unaggregated row is paired with its
+    strongest (largest |a_ij|) unaggregated neighbour, or left alone.
+    Returns the aggregate index of every row and the number of aggregates.
+    """
+    indptr, indices = A.indptr.tolist(), A.indices.tolist()
+    strength = np.abs(A.data).tolist()
+    n = A.shape[0]
+    agg = [-1] * n
+    nc = 0
+    for i in range(n):
+        if agg[i] >= 0:
+            continue
+        best, best_j = 0.0, -1
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            if j != i and agg[j] < 0 and strength[k] > best:
+                best, best_j = strength[k], j
+        agg[i] = nc
+        if best_j >= 0:
+            agg[best_j] = nc
+        nc += 1
+    return np.asarray(agg, np.int64), nc
+
+
+class CpuAMG:
+    """Aggregation AMG with (l1-)Jacobi smoothing and V-cycles."""
+
+    def __init__(self, cfg):
+        c = _solver_cfg(cfg)
+        self.presweeps = c.get("presweeps", 1)
+        self.postsweeps = c.get("postsweeps", 1)
+        self.max_levels = c.get("max_levels", 100)
+        self.max_iters = c.get("max_iters", 100)
+        self.tolerance = c.get("tolerance", 1e-6)
+        self.convergence = c.get("convergence", "ABSOLUTE")
+        self.monitor_residual = c.get("monitor_residual", 0)
+        self.min_coarse_rows = c.get("min_coarse_rows", 2)
+        self.dense_lu_num_rows = c.get("dense_lu_num_rows", 128)
+        selector = c.get("selector", "SIZE_2")
+        if selector not in ("SIZE_2", "SIZE_4", "SIZE_8"):
+            raise ValueError(f"unsupported selector {selector}")
+        self.passes = {"SIZE_2": 1, "SIZE_4": 2, "SIZE_8": 3}[selector]
+        if c.get("cycle", "V") != "V":
+            raise ValueError("only V cycles are supported")
+        self.smoother = c.get("smoother", "JACOBI_L1")
+        if self.smoother not in ("JACOBI_L1", "BLOCK_JACOBI"):
+            raise ValueError(f"unsupported smoother {self.smoother}")
+        self.relaxation_factor = c.get("relaxation_factor", 0.9)
+        self.levels = []
+        self.coarse_lu = None
+
+    def _smoother_diagonal(self, A):
+        if self.smoother == "JACOBI_L1":
+            return np.asarray(abs(A).sum(axis=1)).ravel()
+        return A.diagonal() / self.relaxation_factor
+
+    def _coarsen(self, A):
+        agg = np.arange(A.shape[0])
+        Ac = A
+        for _ in range(self.passes):
+            a, nc = pairwise_aggregate(Ac)
+            agg = a[agg]
+            P = sparse.csr_matrix((np.ones(len(agg), A.dtype),
+                                   (np.arange(len(agg)), agg)),
+                                  shape=(A.shape[0], nc))
+            Ac = (P.T @ A @ P).tocsr()
+        return P, Ac
+
+    def setup(self, A):
+        A = sparse.csr_matrix(A)
+        self.levels = []
+        while (len(self.levels) + 1 < self.max_levels
+               and A.shape[0] > self.min_coarse_rows):
+            P, Ac = self._coarsen(A)
+            if Ac.shape[0] == A.shape[0]:
+                break
+            self.levels.append((A, P, self._smoother_diagonal(A)))
+            A = Ac
+        self._setup_coarse(A)
+
+    def _setup_coarse(self, A):
+        self.coarse = (A, self._smoother_diagonal(A))
+        self.coarse_lu = None
+        if A.shape[0] <= self.dense_lu_num_rows:
+            self.coarse_lu = splu(A.tocsc())
+
+    def resetup(self, A):
+        """Recompute the Galerkin operators of A, keeping the aggregates."""
+        A = sparse.csr_matrix(A)
+        levels = []
+        for _, P, _ in self.levels:
+            levels.append((A, P, self._smoother_diagonal(A)))
+            A = (P.T @ A @ P).tocsr()
+        self.levels = levels
+        self._setup_coarse(A)
+
+    def set_matrix(self, A):
+        """Replace the finest operator only, coarse levels stay stale."""
+        A = sparse.csr_matrix(A)
+        if self.levels:
+            self.levels[0] = (A, self.levels[0][1], self._smoother_diagonal(A))
+        else:  # the finest level is the coarse one, refactor it
+            self._setup_coarse(A)
+
+    def _smooth(self, A, d, b, x, sweeps):
+        for _ in range(sweeps):
+            x += (b - A @ x) / d
+        return x
+
+    def _cycle(self, level, b, x):
+        if level == len(self.levels):
+            if self.coarse_lu is not None:
+                return self.coarse_lu.solve(b)
+            A, d = self.coarse
+            return self._smooth(A, d, b, x,
+                                max(1, self.presweeps + self.postsweeps))
+        A, P, d = self.levels[level]
+        x = self._smooth(A, d, b, x, self.presweeps)
+        r = b - A @ x
+        x += P @ self._cycle(level + 1, P.T @ r, np.zeros(P.shape[1], b.dtype))
+        return self._smooth(A, d, b, x, self.postsweeps)
+
+    def solve(self, b, x=None):
+        x = np.zeros_like(b) if x is None else x.copy()
+        A = self.levels[0][0] if self.levels else self.coarse[0]
+        r0 = np.linalg.norm(b - A @ x) if self.monitor_residual else 0.0
+        for _ in range(self.max_iters):
+            x = self._cycle(0, b, x)
+            if self.monitor_residual:
+                r = np.linalg.norm(b - A @ x)
+                if self.convergence == "ABSOLUTE":
+                    if r < self.tolerance:
+                        break
+                elif r < self.tolerance * r0:
+                    break
+        return x
+
+    def destroy(self):
+        self.levels, self.coarse_lu = [], None
+
+
+class AMGXBackend:
+    """NVIDIA AMGX through pyamgx."""
+
+    def __init__(self, cfg):
+        import pyamgx
+        self.pyamgx = pyamgx
+        pyamgx.initialize()
+        self.cfg = pyamgx.Config().create_from_dict(cfg)
+        self.rsc = pyamgx.Resources().create_simple(self.cfg)
+        self.A = pyamgx.Matrix().create(self.rsc)
+        self.b = pyamgx.Vector().create(self.rsc)
+        self.x = pyamgx.Vector().create(self.rsc)
+        self.solver = pyamgx.Solver().create(self.rsc, self.cfg)
+
+    def setup(self, A):
+        self.A.upload_CSR(sparse.csr_matrix(A))
+        self.solver.setup(self.A)
+
+    def resetup(self, A):
+        self.A.replace_coefficients(sparse.csr_matrix(A).data)
+        self.solver.resetup(self.A)
+
+    def set_matrix(self, A):
+        self.A.replace_coefficients(sparse.csr_matrix(A).data)
+
+    def solve(self, b, x=None):
+        sol = np.zeros_like(b) if x is None else x.copy()
+        self.b.upload(b)
+        self.x.upload(sol)
+        self.solver.solve(self.b, self.x)
+        self.x.download(sol)
+        return sol
+
+    def destroy(self):
+        self.A.destroy()
+        self.x.destroy()
+        self.b.destroy()
+        self.solver.destroy()
+        self.rsc.destroy()
+        self.cfg.destroy()
+        self.pyamgx.finalize()
+
+
+class CachedHierarchy:
+    """
+    Reuse the AMG hierarchy across the iterations of a frame.
+
+    policy is one of
+        "always": full setup on every solve
+        "frame":  full setup on the first solve of a frame, afterwards only
+                  the finest operator is replaced
+        "values": full setup once, value-only resetup on every solve
+        "stall":  full setup once, value-only resetup only after a solve
+                  whose relative residual stayed above stall_ratio
+    """
+
+    policies = ("always", "frame", "values", "stall")
+
+    def __init__(self, backend, policy="always", stall_ratio=0.5):
+        if policy not in self.policies:
+            raise ValueError(f"unknown reuse policy {policy}")
+        self.backend = backend
+        self.policy = policy
+        self.stall_ratio = stall_ratio
+        self.ready = False
+        self.first_in_frame = True
+        self.stalled = False
+        self.solves = 0
+        self.setups = 0
+        self.resetups = 0
+        self.setup_time = 0.0
+        self.full_setup_time = 0.0
+
+    def new_frame(self):
+        self.first_in_frame = True
+
+    def _prepare(self, A):
+        full = (not self.ready or self.policy == "always"
+                or (self.policy == "frame" and self.first_in_frame))
+        start = time.perf_counter()
+        if full:
+            self.backend.setup(A)
+            self.setups += 1
+        elif self.policy == "values" or (self.policy == "stall"
+                                         and self.stalled):
+            self.backend.resetup(A)
+            self.resetups += 1
+        else:
+            self.backend.set_matrix(A)
+        elapsed = time.perf_counter() - start
+        self.setup_time += elapsed
+        if full:
+            self.full_setup_time += elapsed
+        self.ready = True
+        self.first_in_frame = False
+
+    def solve(self, A, b):
+        self._prepare(A)
+        x = self.backend.solve(b)
+        self.solves += 1
+        if self.policy == "stall":
+            b_norm = np.linalg.norm(b)
+            self.stalled = (b_norm > 0 and np.linalg.norm(b - A @ x)
+                            > self.stall_ratio * b_norm)
+        return x
+
+    def stats(self):
+        """Setup counts and times, compare amg_setup_s across policies."""
+        return {
+            "amg_policy": self.policy,
+            "amg_setups": self.setups,
+            "amg_resetups": self.resetups,
+            "amg_setup_s": self.setup_time,
+            "amg_full_setup_s": self.full_setup_time,
+        }
+
+    def destroy(self):
+        self.backend.destroy()
+
+
+def make_backend(cfg, backend="auto"):
+    if backend == "auto":
+        try:
+            import pyamgx  # noqa: F401
+            backend = "amgx"
+        except ImportError:
+            backend = "cpu"
+    if backend == "amgx":
+        return AMGXBackend(cfg)
+    if backend == "cpu":
+        return CpuAMG(cfg)
+    raise ValueError(f"unknown AMG backend {backend}")
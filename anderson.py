@@ -0,0 +1,119 @@
+"""
+Anderson acceleration of the Jacobi position iteration.
+
+One Jacobi sweep, collision handling included, is a fixed-point map
+x -> g(x). With f_k = g(x_k) - x_k and the differences of the last m
+iterates stored column-wise in dF and dG, Anderson's method (type II,
+Walker & Ni 2011) takes
+
+    gamma   = argmin |f_k - dF gamma|
+    x_{k+1} = g(x_k) - dG gamma
+
+The per-particle history lives in Taichi fields allocated once; each
+iteration only copies the m x (m + 1) normal equations into, and the m
+mixing weights out of, preallocated NumPy arrays. The history restarts
+every frame and whenever the normal equations are singular.
+
+    aa = Anderson(positions, m=5)
+    aa.new_frame()
+    for ite in range(max_ite):
+        aa.begin()          # remember x_k
+        jacobi_sweep()      # positions = g(x_k)
+        aa.mix()            # positions = x_{k+1}
+"""
+import numpy as np
+import taichi as ti
+
+
+@ti.data_oriented
+class Anderson:
+    def __init__(self, x, m=5, regularization=1e-10):
+        n = x.shape[0]
+        self.x = x
+        self.m = m
+        self.regularization = regularization
+        self.blocks = min(n, 64)
+        self.x_k = ti.Vector.field(x.n, x.dtype, n)
+        self.f_prev = ti.Vector.field(x.n, x.dtype, n)
+        self.g_prev = ti.Vector.field(x.n, x.dtype, n)
+        self.dF = ti.Vector.field(x.n, x.dtype, (m, n))
+        self.dG = ti.Vector.field(x.n, x.dtype, (m, n))
+        self.system = ti.field(ti.f64, (m, m + 1))  # [dF^T dF | dF^T f_k]
+        self.system_host = np.zeros((m, m + 1), np.float64)
+        self.gamma = np.zeros(m, np.float64 if x.dtype == ti.f64 else np.float32)
+        self.restarts = 0
+        self.new_frame()
+
+    def new_frame(self):
+        self.started = False  # f_prev and g_prev hold the last iterate
+        self.columns = 0
+        self.col = 0
+
+    @ti.kernel
+    def begin(self):
+        for p in self.x:
+            self.x_k[p] = self.x[p]
+
+    @ti.kernel
+    def _update_history(self, col: ti.i32, write: ti.i32, count: ti.i32,
+                        out: ti.types.ndarray()):
+        for i, j in self.system:
+            self.system[i, j] = 0.0
+        for p in self.x:
+            f = self.x[p] - self.x_k[p]
+            if write:
+                self.dF[col, p] = f - self.f_prev[p]
+                self.dG[col, p] = self.x[p] - self.g_prev[p]
+            self.f_prev[p] = f
+            self.g_prev[p] = self.x[p]
+        # column count holds dF^T f_k; every entry is summed in `blocks`
+        # strided chunks, which avoids contended atomics on m x m cells
+        n, blocks = ti.static(self.x.shape[0], self.blocks)
+        for i, j, c in ti.ndrange(count, count + 1, blocks):
+            acc = ti.cast(0.0, ti.f64)
+            for k in range((n - c + blocks - 1) // blocks):
+                p = c + k * blocks
+                other = self.f_prev[p]
+                if j < count:
+                    other = self.dF[j, p]
+                acc += ti.cast(self.dF[i, p].dot(other), ti.f64)
+            self.system[i, ti.min(j, self.m)] += acc
+        for i, j in self.system:
+            out[i, j] = self.system[i, j]
+
+    @ti.kernel
+    def _mix(self, count: ti.i32, gamma: ti.types.ndarray()):
+        for p in self.x:
+            x = self.x[p]
+            for i in range(count):
+                x -= gamma[i] * self.dG[i, p]
+            self.x[p] = x
+
+    def mix(self):
+        """Replace g(x_k) in x by the Anderson iterate x_{k+1}."""
+        if self.started:
+            self.columns = min(self.columns + 1, self.m)
+        count = self.columns
+        self._update_history(self.col, int(self.started), count,
+                             self.system_host)
+        if self.started:
+            self.col = (self.col + 1) % self.m
+        self.started = True
+        if count == 0:
+            return
+        H = self.system_host[:count, :count]
+        b = self.system_host[:count, self.m]
+        H[np.diag_indices(count)] += self.regularization * max(np.trace(H), 1e-30)
+        try:
+            gamma = np.linalg.solve(H, b)
+        except np.linalg.LinAlgError:
+            gamma = None
+        if gamma is None or not np.all(np.isfinite(gamma)):
+            self.columns = 0
+            self.restarts += 1
+            return
+        self.gamma[:count] = gamma
+        self._mix(count, self.gamma)
+
+    def stats(self):
+        return {"anderson_m": self.m, "anderson_restarts": self.restarts}
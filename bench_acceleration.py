@@ -0,0 +1,53 @@
+"""
+Compare plain Jacobi with the Chebyshev and Anderson accelerated modes.
+Every run is a separate headless process; the residual column is the
+constraint violation after the last frame, so lower is better at equal
+iteration counts.
+
+    python bench_acceleration.py --max-ite 10 30 100 --frames 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+RUNS = {
+    "rod": [("2_1_pbd_rod_jacobi.py", "jacobi"),
+            ("2_1_pbd_rod_jacobi.py", "chebyshev"),
+            ("2_1_pbd_rod_jacobi.py", "anderson")],
+    "mesh": [("6_pbd_mesh_jacobi.py", "jacobi"),
+             ("6_pbd_mesh_jacobi.py", "anderson"),
+             ("7_pbd_mesh_jacobi_chebyshev.py", "jacobi"),
+             ("7_pbd_mesh_jacobi_chebyshev.py", "chebyshev")],
+}
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--scenes", nargs="+", choices=tuple(RUNS),
+                    default=list(RUNS))
+parser.add_argument("--rod-size", type=int, default=50)
+parser.add_argument("--mesh-size", type=int, default=20)
+parser.add_argument("--max-ite", type=int, nargs="+", default=[10, 30, 100])
+parser.add_argument("--frames", type=int, default=100)
+parser.add_argument("--anderson-m", type=int, default=5)
+parser.add_argument("--arch", choices=("cpu", "gpu"), default="cpu")
+args = parser.parse_args()
+root = os.path.dirname(os.path.abspath(__file__))
+
+print(f"{'scene':>5} {'script':>32} {'solver':>10} {'max_ite':>8} "
+      f"{'frames/s':>10} {'residual':>12}")
+for scene in args.scenes:
+    size = (["--n", str(args.rod_size)] if scene == "rod"
+            else ["--N", str(args.mesh_size)])
+    for max_ite in args.max_ite:
+        for script, solver in RUNS[scene]:
+            extra = ["--anderson-m", str(args.anderson_m)] if solver == "anderson" else []
+            out = subprocess.run(
+                [sys.executable, os.path.join(root, script), "--headless",
+                 "--json", "--solver", solver, "--arch", args.arch,
+                 "--frames", str(args.frames), "--max-ite", str(max_ite)]
+                + size + extra,
+                check=True, capture_output=True, text=True).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"{scene:>5} {script:>32} {solver:>10} {max_ite:>8} "
+                  f"{r['frames_per_s']:>10.1f} {r['residual']:>12.4e}")
@@ -0,0 +1,50 @@
+"""
+Measure what the AMG reuse policies of amg.CachedHierarchy save.
+Every policy runs 2_4_pbd_rod_real_amgx.py as a separate headless process
+on the same rod; the saved columns are the measured differences to the
+"always" run (full setup on every solve), negative when a policy cost more.
+The hierarchy is multilevel (--max-levels): with the single level of the
+script's default every policy does the same work.
+
+    python bench_amg_reuse.py --sizes 101 1001 --frames 100 --backend cpu
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from amg import CachedHierarchy
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--sizes", type=int, nargs="+", default=[101, 1001])
+parser.add_argument("--frames", type=int, default=100)
+parser.add_argument("--max-ite", type=int, default=5)
+parser.add_argument("--max-levels", type=int, default=10)
+parser.add_argument("--backend", choices=("auto", "amgx", "cpu"),
+                    default="cpu")
+parser.add_argument("--arch", choices=("cpu", "gpu"), default="cpu")
+args = parser.parse_args()
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "2_4_pbd_rod_real_amgx.py")
+
+print(f"{'n':>6} {'policy':>7} {'setups':>7} {'setup_s':>9} "
+      f"{'saved_setup_s':>14} {'seconds':>9} {'saved_s':>9} {'residual':>12}")
+for n in args.sizes:
+    baseline = None
+    for policy in CachedHierarchy.policies:  # "always" first
+        out = subprocess.run(
+            [sys.executable, script, "--headless", "--json", "--n", str(n),
+             "--solver", "amgx", "--backend", args.backend,
+             "--amg-reuse", policy, "--arch", args.arch,
+             "--frames", str(args.frames), "--max-ite", str(args.max_ite),
+             "--max-levels", str(args.max_levels)],
+            check=True, capture_output=True, text=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        baseline = baseline or r
+        print(f"{n:>6} {policy:>7} {r['amg_setups']:>7} "
+              f"{r['amg_setup_s']:>9.4f} "
+              f"{baseline['amg_setup_s'] - r['amg_setup_s']:>14.4f} "
+              f"{r['seconds']:>9.4f} "
+              f"{baseline['seconds'] - r['seconds']:>9.4f} "
+              f"{r['residual']:>12.4e}")
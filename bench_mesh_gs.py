@@ -0,0 +1,39 @@
+"""
+Benchmark graph-colored Gauss-Seidel against the original racy GS kernel
+of 5_pbd_mesh_gs.py. Every run is a separate headless process. The cloth
+hangs from its pinned top corners, so the constraints never settle to zero
+and the residuals after the same number of iterations per frame compare
+the convergence of the two sweeps.
+
+    python bench_mesh_gs.py --sizes 10 50 100 --frames 100 --max-ite 5 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100])
+parser.add_argument("--frames", type=int, default=100)
+parser.add_argument("--max-ite", type=int, nargs="+", default=[5, 10, 20],
+                    help="iterations per frame, every run does exactly these")
+parser.add_argument("--arch", choices=("cpu", "gpu"), default="cpu")
+args = parser.parse_args()
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "5_pbd_mesh_gs.py")
+
+print(f"{'N':>6} {'max_ite':>8} {'solver':>12} {'frames/s':>10} "
+      f"{'ite/s':>12} {'residual':>12}")
+for N in args.sizes:
+    for max_ite in args.max_ite:
+        for solver in ("gs", "colored_gs"):
+            out = subprocess.run(
+                [sys.executable, script, "--headless", "--json", "--pin",
+                 "--N", str(N), "--solver", solver, "--arch", args.arch,
+                 "--frames", str(args.frames), "--max-ite", str(max_ite)],
+                check=True, capture_output=True, text=True).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"{N:>6} {max_ite:>8} {solver:>12} "
+                  f"{r['frames_per_s']:>10.1f} {r['iterations_per_s']:>12.1f} "
+                  f"{r['residual']:>12.4e}")
@@ -0,0 +1,195 @@
+"""
+Convergence and throughput benchmark of every solver variant.
+
+All solvers run the same fixed scenes (rods of n particles, cloths of
+N x N cells) with the same time step and frame count, once per iteration
+count in --iterations. Every run is a fresh process, so the peak resident
+memory and the warmup (JIT compile) time belong to that run alone. The
+report holds, per scene, size and solver,
+
+    residual_vs_iteration       convergence curve: dual residual norm at
+                                every iteration of the last frame of the
+                                run with the most iterations, from its
+                                residual log
+    residual_vs_seconds         the same curve against the time spent on
+                                the iterations, seconds_per_iteration each
+    final_residual_vs_max_ite   constraint violation at the end of the run
+                                for every --iterations setting
+    final_residual_vs_seconds   the same against each run's timed seconds
+    seconds_per_iteration       from the longest run
+    warmup_seconds              first frame, dominated by kernel compilation
+    max_rss_mb                  peak resident memory of the process
+
+plus every raw run, and is written as JSON. A run that succeeds without
+leaving a residual log fails the suite once the report is written. The
+cloth of 5_pbd_mesh_gs.py runs with --pin, like the other cloths.
+
+    python bench_suite.py --rod-sizes 10 50 100 --mesh-sizes 5 20 \
+        --iterations 1 5 20 100 --workers 4 --out bench_report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import sweep
+from residual_log import load_residuals
+
+SOLVERS = {
+    "rod": [("1_pbd_rod_gs.py", "gs", {}),
+            ("2_pbd_rod_jacobi.py", "jacobi", {}),
+            ("2_1_pbd_rod_jacobi.py", "jacobi", {}),
+            ("2_1_pbd_rod_jacobi.py", "chebyshev", {}),
+            ("2_1_pbd_rod_jacobi.py", "anderson", {}),
+            ("2_2_pbd_rod_jacobi.py", "sc_jacobi", {}),
+            ("2_2_pbd_rod_jacobi.py", "tridiag", {}),
+            ("2_3_pbd_rod_fake_amgx.py", "fake_amgx", {}),
+            ("2_4_pbd_rod_real_amgx.py", "amgx", {"backend": "auto"})],
+    "mesh": [("5_pbd_mesh_gs.py", "gs", {"pin": "on"}),
+             ("5_pbd_mesh_gs.py", "colored_gs", {"pin": "on"}),
+             ("6_pbd_mesh_jacobi.py", "jacobi", {}),
+             ("6_pbd_mesh_jacobi.py", "anderson", {}),
+             ("7_pbd_mesh_jacobi_chebyshev.py", "jacobi", {}),
+             ("7_pbd_mesh_jacobi_chebyshev.py", "chebyshev", {})],
+}
+
+
+def measure(job):
+    script, options = job
+    row = sweep.run(script, options)
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    row["max_rss_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                         * scale / 2**20)
+    return row
+
+
+def iteration_curve(row):
+    """Residual norms of every iteration of the run's last logged frame."""
+    path = row.get("residual-log")
+    if not path or not os.path.exists(path):
+        return None
+    log = load_residuals(path)
+    if len(log["frame"]) == 0:
+        return None
+    last = log["frame"] == log["frame"].max()
+    order = np.argsort(log["iteration"][last], kind="stable")
+    return log["residual"][last][order].tolist()
+
+
+def summarize(rows):
+    curves = {}
+    for row in rows:
+        if "error" in row:
+            continue
+        key = (row["scene_kind"], row["size"], row["script"], row["solver"])
+        curves.setdefault(key, []).append(row)
+    summary = []
+    for (kind, size, script, solver), runs in sorted(curves.items()):
+        runs.sort(key=lambda r: r["max_ite"])
+        longest = runs[-1]
+        per_iteration = longest["seconds"] / max(longest["iterations"], 1)
+        curve = iteration_curve(longest)
+        summary.append({
+            "scene": kind, "size": size, "script": script, "solver": solver,
+            "iterations": [r["max_ite"] for r in runs],
+            "residual_vs_iteration": curve,
+            "residual_vs_seconds": None if curve is None else [
+                [k * per_iteration, r] for k, r in enumerate(curve)],
+            "final_residual_vs_max_ite": [r["residual"] for r in runs],
+            "final_residual_vs_seconds": [[r["seconds"], r["residual"]]
+                                          for r in runs],
+            "seconds_per_iteration": per_iteration,
+            "warmup_seconds": min(r["warmup_seconds"] for r in runs),
+            "max_rss_mb": max(r["max_rss_mb"] for r in runs),
+        })
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenes", nargs="+", choices=tuple(SOLVERS),
+                        default=list(SOLVERS))
+    parser.add_argument("--rod-sizes", type=int, nargs="+",
+                        default=[10, 50, 100])
+    parser.add_argument("--mesh-sizes", type=int, nargs="+",
+                        default=[5, 20, 50])
+    parser.add_argument("--iterations", type=int, nargs="+",
+                        default=[1, 5, 20, 100])
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--h", type=float, default=0.01)
+    parser.add_argument("--arch", choices=("cpu", "gpu"), default="cpu")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="bench_report.json")
+    parser.add_argument("--logs", metavar="DIR",
+                        help="residual logs of the runs (default: --out "
+                             "without its extension, plus _logs)")
+    args = parser.parse_args()
+    logs = args.logs or os.path.splitext(args.out)[0] + "_logs"
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    jobs = []
+    for kind in args.scenes:
+        size_key = "n" if kind == "rod" else "N"
+        sizes = args.rod_sizes if kind == "rod" else args.mesh_sizes
+        for size in sizes:
+            for script, solver, extra in SOLVERS[kind]:
+                for max_ite in args.iterations:
+                    path = os.path.join(root, script)
+                    jobs.append((path, sweep.run_outputs(path, {
+                        "arch": args.arch, "frames": args.frames,
+                        "h": args.h, size_key: size, "solver": solver,
+                        "max-ite": max_ite, **extra}, logs, len(jobs))))
+
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    rows = []
+    start = time.perf_counter()
+    # a fresh process per run keeps the memory and compile numbers apart
+    with multiprocessing.Pool(args.workers, sweep.init_worker, (threads,),
+                              maxtasksperchild=1) as pool:
+        for k, row in enumerate(pool.imap(measure, jobs)):
+            size = row.get("n", row.get("N"))
+            row["scene_kind"] = "rod" if "n" in jobs[k][1] else "mesh"
+            row["size"] = size
+            rows.append(row)
+            status = row.get("error") or f"residual={row['residual']:.3e}"
+            print(f"[{k + 1}/{len(jobs)}] {row['script']} {row['solver']} "
+                  f"size={size} max_ite={jobs[k][1]['max-ite']} {status}",
+                  flush=True)
+
+    import taichi as ti
+    report = {
+        "meta": {
+            "taichi": ".".join(map(str, ti.__version__)),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "arch": args.arch, "frames": args.frames, "h": args.h,
+            "workers": args.workers,
+            "wall_seconds": time.perf_counter() - start,
+        },
+        "summary": summarize(rows),
+        "runs": rows,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"{len(rows)} runs, {sum('error' in r for r in rows)} failed, "
+          f"written to {args.out}")
+    missing = [f"{s['script']} {s['solver']} size={s['size']}"
+               for s in report["summary"]
+               if s["residual_vs_iteration"] is None]
+    if missing:
+        raise SystemExit("no residual log, so no convergence curve, for: "
+                         + ", ".join(missing))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Chebyshev semi-iterative acceleration of the Jacobi solvers (Wang 2015).
+
+After every Jacobi sweep x_hat the positions are blended with the iterate
+of two sweeps ago,
+
+    x_{k+1} = omega_{k+1} * (x_hat - x_{k-1}) + x_{k-1}
+    omega_1 = 1,  omega_2 = 2 / (2 - rho^2),
+    omega_{k+1} = 4 / (4 - rho^2 * omega_k)
+
+where rho is the spectral radius of the Jacobi iteration. Instead of a
+hand-tuned rho, ChebyshevAccelerator estimates it from the dual residual
+ratios of the plain Jacobi warm-up iterations of every frame. Jacobi
+residuals jitter from one iteration to the next, so divergence means
+growing past `divergence` times the smallest residual since the recurrence
+started. Then rho is shrunk, later estimates are capped below it and the
+recurrence restarts from omega = 1. The cap is relaxed again after every
+frame without a fallback.
+
+    cheb = ChebyshevAccelerator(warmup=10)
+    cheb.new_frame()
+    for ite in range(max_ite):
+        r = compute_residual()      # before this iteration's update
+        solve_constraints()
+        apply_chebyshev(cheb.step(r))
+
+Scripts that keep the residuals on the device use schedule() for the next
+frames and observe() the residuals once they are read back.
+"""
+import math
+
+import numpy as np
+
+
+class ChebyshevAccelerator:
+    def __init__(self, warmup=10, rho=None, safety=0.99, divergence=1.5,
+                 shrink=0.9, max_rho=0.9999, dtype=np.float32):
+        self.warmup = warmup
+        self.dtype = dtype  # of schedule(), the scripts' float type
+        self.fixed_rho = rho  # None: estimate from the residuals
+        self.rho = 0.0 if rho is None else rho
+        self.safety = safety
+        self.divergence = divergence
+        self.shrink = shrink
+        self.max_rho = max_rho
+        self.cap = max_rho
+        self.fallbacks = 0
+        self.stable = True
+        self.new_frame()
+
+    def new_frame(self):
+        self._relax_cap()
+        self.ite = 0
+        self.k = 0  # iterations since the recurrence (re)started
+        self.omega = 1.0
+        self.previous = None
+        self.best = math.inf
+        self.ratios = []
+        self.enabled = True
+
+    def _estimate(self, ratios):
+        # the first ratios are dominated by the fast modes, use the tail
+        tail = [r for r in ratios[len(ratios) // 2:] if r > 0.0]
+        if not tail:
+            return self.rho
+        rho = self.safety * math.exp(sum(map(math.log, tail)) / len(tail))
+        return min(rho, self.cap)
+
+    def _fall_back(self):
+        self.rho = self.cap = self.rho * self.shrink
+        self.fallbacks += 1
+        self.stable = False
+
+    def _relax_cap(self):
+        if self.stable:
+            self.cap = min(self.cap / self.shrink, self.max_rho)
+        self.stable = True
+
+    def _omega(self, k, omega):
+        if k == 0:
+            return 1.0
+        if k == 1:
+            return 2.0 / (2.0 - self.rho * self.rho)
+        return 4.0 / (4.0 - self.rho * self.rho * omega)
+
+    def _next_omega(self):
+        self.omega = self._omega(self.k, self.omega)
+        self.k += 1
+        return self.omega
+
+    def step(self, residual):
+        """Take the residual of this iteration, return its omega."""
+        ite, previous = self.ite, self.previous
+        self.ite += 1
+        self.previous = residual
+        if not math.isfinite(residual):
+            if self.enabled:
+                self._fall_back()
+            self.enabled = False  # plain Jacobi for the rest of the frame
+            return 1.0
+        if ite < self.warmup:
+            if previous:
+                self.ratios.append(residual / previous)
+            if ite == self.warmup - 1 and self.fixed_rho is None:
+                self.rho = self._estimate(self.ratios)
+            return 1.0
+        if not self.enabled:
+            return 1.0
+        if residual > self.divergence * self.best:
+            self._fall_back()
+            self.k = 0
+            self.best = residual
+        self.best = min(self.best, residual)
+        return self._next_omega()
+
+    def schedule(self, max_ite):
+        """omega of every iteration of a frame for the current rho."""
+        omegas = [1.0] * max_ite
+        omega = 1.0
+        for k in range(max_ite - self.warmup):
+            omega = omegas[self.warmup + k] = self._omega(k, omega)
+        return np.array(omegas, self.dtype)
+
+    def observe(self, residuals):
+        """Update rho from the residuals of a frame run with schedule()."""
+        residuals = [float(r) for r in residuals]
+        if not all(map(math.isfinite, residuals)):
+            self._fall_back()
+            return
+        head = residuals[:self.warmup]
+        if self.fixed_rho is None and len(head) > 1:
+            self.rho = self._estimate([b / a for a, b in zip(head, head[1:])
+                                       if a > 0.0])
+        tail = residuals[self.warmup:]
+        if tail and max(tail) > self.divergence * min(residuals[:self.warmup + 1]):
+            self._fall_back()
+        self._relax_cap()
+
+    def stats(self):
+        return {"cheb_rho": self.rho, "cheb_fallbacks": self.fallbacks}
@@ -0,0 +1,125 @@
+"""
+Checkpoint and restart of the simulation state.
+
+save_checkpoint() writes named Taichi fields to one contiguous binary file
+
+    magic | uint64 len(index) | index (JSON: name, dtype, shape, offset
+    of every array, plus free-form meta) | arrays, 64-byte aligned
+
+and load_checkpoint() copies them back into fields of the same shapes, with
+one read of the whole file or, with mmap=True, through a memory map that
+only pages in what the copies touch. The scripts save their positions,
+previous positions, velocities, inverse masses, rest lengths and topology
+with --checkpoint at the end of a run and restore them with --restore
+instead of starting from the initial pose, so a scene settles once and
+many runs start from there:
+
+    python 6_pbd_mesh_jacobi.py --headless --N 200 --frames 2000 \
+        --checkpoint settled.ckpt
+    python sweep.py 6_pbd_mesh_jacobi.py --grid max-ite=5,20,50 \
+        --set N=200 restore=settled.ckpt
+
+    python checkpoint.py settled.ckpt  # list the arrays of a checkpoint
+"""
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"PBDCKPT1"
+_LENGTH = struct.Struct("<Q")
+ALIGN = 64
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def save_checkpoint(path, fields, **meta):
+    """Write a dict of name: field to path, replacing it atomically."""
+    arrays = {name: field.to_numpy() for name, field in fields.items()}
+    entries, offset = [], 0
+    for name, array in arrays.items():
+        entries.append({"name": name, "dtype": array.dtype.str,
+                        "shape": list(array.shape), "offset": offset})
+        offset = _aligned(offset + array.nbytes)
+    index = json.dumps({"arrays": entries, "meta": meta},
+                       default=str).encode()
+    start = _aligned(len(MAGIC) + _LENGTH.size + len(index))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC + _LENGTH.pack(len(index)) + index)
+        for entry, array in zip(entries, arrays.values()):
+            f.seek(start + entry["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + offset)
+    os.replace(path + ".tmp", path)
+
+
+def read_index(path):
+    """The index of a checkpoint and the file offset its arrays start at."""
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC) + _LENGTH.size)
+        if len(head) < len(MAGIC) + _LENGTH.size or not head.startswith(MAGIC):
+            raise ValueError(f"{path} is not a checkpoint")
+        (length,) = _LENGTH.unpack_from(head, len(MAGIC))
+        index = json.loads(f.read(length))
+    return index, _aligned(len(MAGIC) + _LENGTH.size + length)
+
+
+def load_checkpoint(path, fields, mmap=False):
+    """Copy the arrays of path into a dict of name: field, return its meta."""
+    index, start = read_index(path)
+    entries = {entry["name"]: entry for entry in index["arrays"]}
+    missing = [name for name in fields if name not in entries]
+    if missing:
+        raise ValueError(f"{path} has no {', '.join(missing)}")
+    for name, field in fields.items():
+        shape = tuple(entries[name]["shape"])
+        if shape[:len(field.shape)] != tuple(field.shape):
+            raise ValueError(f"{name} of {path} has shape {shape}, "
+                             f"the scene has {tuple(field.shape)}")
+    if mmap:
+        data = np.memmap(path, np.uint8, "r")
+    else:
+        data = np.fromfile(path, np.uint8)
+    for name, field in fields.items():
+        entry = entries[name]
+        dtype = np.dtype(entry["dtype"])
+        begin = start + entry["offset"]
+        count = int(np.prod(entry["shape"])) * dtype.itemsize
+        field.from_numpy(data[begin:begin + count].view(dtype)
+                         .reshape(entry["shape"]))
+    return index["meta"]
+
+
+def restore(args, fields):
+    """load_checkpoint() from --restore, if given."""
+    if args.restore is not None:
+        load_checkpoint(args.restore, fields, args.restore_mmap)
+
+
+def checkpoint(args, fields):
+    """save_checkpoint() to --checkpoint, if given."""
+    if args.checkpoint is not None:
+        save_checkpoint(args.checkpoint, fields,
+                        script=os.path.basename(sys.argv[0]),
+                        options={k: v for k, v in vars(args).items()
+                                 if k not in ("checkpoint", "restore")})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect a checkpoint")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    index, _ = read_index(args.path)
+    print(json.dumps(index["meta"]))
+    for entry in index["arrays"]:
+        print(f"{entry['name']}: {np.dtype(entry['dtype'])} "
+              f"{tuple(entry['shape'])}")
@@ -0,0 +1,31 @@
+"""
+Flush and close hooks for the files a run writes.
+
+The residual logs, trajectories and profiles register their flush or
+close here instead of with atexit directly. The hooks still run at
+interpreter exit, latest first, as atexit would run them. sweep.run()
+executes many configurations in one pool worker, which never runs
+atexit, so it calls close_all() after every configuration:
+
+    closing.register(recorder.close)
+    ...
+    closing.close_all()  # flush and close everything registered so far
+"""
+import atexit
+
+_hooks = []
+
+
+def register(hook):
+    """Call hook() at close_all() or at exit, whichever comes first."""
+    _hooks.append(hook)
+    return hook
+
+
+def close_all():
+    """Run and forget every registered hook, latest first."""
+    while _hooks:
+        _hooks.pop()()
+
+
+atexit.register(close_all)
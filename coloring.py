@@ -0,0 +1,31 @@
+"""
+Edge graph coloring for race-free parallel Gauss-Seidel.
+
+Two edges get different colors whenever they share a vertex, so all edges of
+one color can be projected in parallel without write conflicts. Launching one
+kernel per color gives a deterministic Gauss-Seidel sweep.
+"""
+import numpy as np
+
+
+def color_edges(edges, n_vertices):
+    """
+    Greedy coloring of an arbitrary (NE, 2) edge list.
+
+    Returns (order, offsets): order lists edge indices grouped by color and
+    the edges of color c are order[offsets[c]:offsets[c + 1]]. The structured
+    grid of init_edge() comes out with four colors.
+    """
+    edges = np.asarray(edges)
+    used = [0] * n_vertices  # bitmask of colors already touching each vertex
+    colors = np.empty(len(edges), np.int32)
+    for e, (a, b) in enumerate(edges.tolist()):
+        mask = used[a] | used[b]
+        c = (~mask & (mask + 1)).bit_length() - 1  # lowest free color
+        colors[e] = c
+        used[a] |= 1 << c
+        used[b] |= 1 << c
+    order = np.argsort(colors, kind="stable").astype(np.int32)
+    offsets = np.zeros(colors.max(initial=-1) + 2, np.int32)
+    np.cumsum(np.bincount(colors), out=offsets[1:])
+    return order, offsets.tolist()
@@ -0,0 +1,131 @@
+"""
+Kernel compile caching and prewarming for the solver scripts.
+
+Taichi compiles a kernel the first time it is launched, so every run pays
+for compiling all of its kernels inside the first frame. With --cache-dir
+the compiled kernels are kept in Taichi's offline cache, in one directory
+per script and configuration, and the next run with the same scene
+constants loads them instead of compiling; with --prewarm the kernels are
+compiled right after they are defined instead of in the first frame:
+
+    args = make_parser(...).parse_args()
+    cache = CompileCache.from_args(args, __file__)
+    cache.init()  # instead of ti.init(arch=...)
+    ...  # fields and kernels
+    cache.prewarm(globals())
+
+    python sweep.py 2_1_pbd_rod_jacobi.py --grid n=10,100 \
+        --set cache-dir=ticache prewarm=on
+
+The configuration key hashes every option but those that only steer the
+run (frames, output, time step, ...), so it may keep more copies than
+Taichi needs but never mixes scene sizes or precisions. The headless
+report says whether the cache was cold or warm and how long ti.init() and
+the prewarming took; warmup_seconds is what is left of the compilation
+in the first frame. Prewarming compiles every kernel of the script, also
+those of the variants not in use, so it moves the compilation out of the
+first frame rather than saving any; the saving comes from a warm cache.
+Only kernels with scalar arguments can be prewarmed, the others still
+compile on their first launch (and are cached as well). Taichi versions
+without an offline cache run uncached.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+
+import taichi as ti
+from taichi.lang import impl
+
+# options that do not change any kernel
+RUN_OPTIONS = {"headless", "frames", "warmup", "json", "profile", "cache_dir",
+               "prewarm", "h", "tol", "rtol", "budget_ms", "out", "show",
+               "checkpoint", "restore", "restore_mmap", "record",
+               "record_frames", "residual_log"}
+
+
+def _scalar(annotation):
+    """A dummy value for a scalar kernel argument, None for other kinds."""
+    if any(annotation is t for t in (ti.f16, ti.f32, ti.f64)):
+        return 0.0
+    if any(annotation is t for t in (ti.i8, ti.i16, ti.i32, ti.i64,
+                                     ti.u8, ti.u16, ti.u32, ti.u64)):
+        return 0
+    return None
+
+
+class CompileCache:
+    def __init__(self, arch, directory=None, prewarm=False):
+        self.arch = arch
+        self.directory = directory
+        self.prewarm_enabled = prewarm
+        self.supported = hasattr(impl.default_cfg(), "offline_cache")
+        self.state = "default"
+        self.init_seconds = 0.0
+        self.prewarm_seconds = 0.0
+        self.prewarmed = 0
+
+    @classmethod
+    def from_args(cls, args, script):
+        directory = None
+        if args.cache_dir is not None:
+            options = {k: v for k, v in sorted(vars(args).items())
+                       if k not in RUN_OPTIONS}
+            key = json.dumps([ti.__version__, options], default=str)
+            digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+            name = os.path.splitext(os.path.basename(script))[0]
+            directory = os.path.join(args.cache_dir, f"{name}-{digest}")
+        return cls(args.arch, directory, args.prewarm)
+
+    def init(self, **kwargs):
+        """ti.init() on self.arch, with the offline cache in self.directory."""
+        if self.directory is not None:
+            if self.supported:
+                self.state = ("warm" if os.path.isdir(self.directory)
+                              and os.listdir(self.directory) else "cold")
+                os.makedirs(self.directory, exist_ok=True)
+                kwargs.update(offline_cache=True,
+                              offline_cache_file_path=self.directory)
+            else:
+                self.state = "unsupported"
+                print("this Taichi version has no offline cache, "
+                      "--cache-dir is ignored", file=sys.stderr)
+        start = time.perf_counter()
+        ti.init(arch=getattr(ti, self.arch), **kwargs)
+        self.init_seconds = time.perf_counter() - start
+
+    def prewarm(self, namespace):
+        """Compile the kernels of a module's globals() before their launch."""
+        if not self.prewarm_enabled:
+            return
+        start = time.perf_counter()
+        for value in list(namespace.values()):
+            if getattr(value, "_is_wrapped_kernel", False):
+                self.prewarmed += self._compile(value._primal)
+        self.prewarm_seconds = time.perf_counter() - start
+
+    @staticmethod
+    def _compile(kernel):
+        if hasattr(kernel, "arguments"):
+            annotations = [arg.annotation for arg in kernel.arguments]
+        else:  # older Taichi
+            annotations = kernel.argument_annotations
+        args = [_scalar(annotation) for annotation in annotations]
+        if any(arg is None for arg in args):
+            return 0  # fields, arrays and templates: compiled on launch
+        key = kernel.ensure_compiled(*args)
+        prog = impl.get_runtime().prog
+        if hasattr(prog, "compile_kernel"):
+            # ensure_compiled only builds the IR, compile it as a launch would
+            prog.compile_kernel(prog.config(), prog.get_device_caps(),
+                                kernel.compiled_kernels[key])
+        return 1
+
+    def stats(self):
+        return {
+            "compile_cache": self.state,
+            "init_seconds": self.init_seconds,
+            "prewarm_seconds": self.prewarm_seconds,
+            "prewarmed_kernels": self.prewarmed,
+        }
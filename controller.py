@@ -0,0 +1,114 @@
+"""
+Per-frame iteration control for the solver scripts.
+
+Instead of always running --max-ite iterations, a frame stops as soon as
+the dual residual is below --tol (absolute) or below --rtol times the
+residual of its first iteration, or when --budget-ms of wall-clock time
+has been spent on its iterations:
+
+    args = make_parser(..., control=True).parse_args()
+    control = IterationController.from_args(args)
+    control.new_frame()
+    for ite in range(max_ite):
+        residual = solve(ite)
+        if control.done(ite, residual):
+            break
+    control.end_frame()
+
+The residual tests need the residual on the host every iteration, so they
+cannot be combined with --residual-every or --fuse. The time budget works
+with everything but --fuse frame; with device-side residuals it measures
+the time spent launching the iterations, not running them.
+"""
+import math
+import time
+
+import numpy as np
+
+
+class IterationController:
+    def __init__(self, max_ite, tol=None, rtol=None, budget=None,
+                 squared=False):
+        self.max_ite = max_ite
+        self.squared = squared  # residuals come in as sums of squares
+        self.tol = tol
+        self.rtol = rtol
+        self.budget = budget  # seconds
+        self.total = 0
+        self.reset()
+        self.new_frame()
+
+    def reset(self):
+        """Forget the per-frame statistics, e.g. of JIT warmup frames."""
+        self.counts = []  # iterations used by every frame
+        self.over_budget = 0
+        self.converged = 0
+
+    @classmethod
+    def from_args(cls, args, squared=False):
+        host_residual = (getattr(args, "residual_every", 0) == 0
+                         and getattr(args, "fuse", "none") == "none")
+        if (args.tol is not None or args.rtol is not None) and not host_residual:
+            raise SystemExit("--tol and --rtol need the residual on the host, "
+                             "drop --residual-every and --fuse")
+        if args.budget_ms is not None and getattr(args, "fuse", "none") == "frame":
+            raise SystemExit("--budget-ms cannot interrupt --fuse frame")
+        budget = None if args.budget_ms is None else args.budget_ms * 1e-3
+        return cls(args.max_ite, args.tol, args.rtol, budget, squared)
+
+    @property
+    def active(self):
+        return (self.tol is not None or self.rtol is not None
+                or self.budget is not None)
+
+    @property
+    def last(self):
+        return self.counts[-1] if self.counts else None
+
+    def new_frame(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.iterations = 0
+        self.stopped = None
+
+    def done(self, ite, residual=None):
+        """Account for iteration ite; True when the frame should stop."""
+        self.iterations = ite + 1
+        if residual is not None:
+            if self.squared:
+                residual = math.sqrt(residual)
+            if self.first is None:
+                self.first = residual
+            if ((self.tol is not None and residual <= self.tol)
+                    or (self.rtol is not None
+                        and residual <= self.rtol * self.first)):
+                self.stopped = "converged"
+                return True
+        if (self.budget is not None
+                and time.perf_counter() - self.start > self.budget):
+            self.stopped = "budget"
+            return True
+        return False
+
+    def end_frame(self, iterations=None):
+        """Record the frame, return the iterations it used."""
+        if iterations is not None:  # frames run without done()
+            self.iterations = iterations
+        self.counts.append(self.iterations)
+        self.total += self.iterations
+        if self.stopped == "converged":
+            self.converged += 1
+        elif self.stopped == "budget":
+            self.over_budget += 1
+        return self.iterations
+
+    def stats(self):
+        counts = np.asarray(self.counts or [0])
+        return {
+            "ite_mean": float(counts.mean()),
+            "ite_min": int(counts.min()),
+            "ite_max": int(counts.max()),
+            "frames_converged": self.converged,
+            "frames_over_budget": self.over_budget,
+            "ite_per_frame": [int(c) for c in self.counts],
+        }
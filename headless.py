@@ -0,0 +1,191 @@
+"""
+Headless stepping and benchmarking shared by the PBD solver scripts.
+
+Every solver script parses its scene size, time step, iteration count and
+solver variant with parse_args(). With --headless the GUI loop is skipped and
+the script's step(n_frames) function is timed by run_headless() instead, e.g.
+
+    python 5_pbd_mesh_gs.py --headless --N 50 --max-ite 20 --frames 200
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import taichi as ti
+
+
+def make_parser(description=None, n=None, N=None, h=0.01, max_ite=10,
+                solvers=("default",), arch="cpu", history=False, mesh=False,
+                fuse=False, control=False, profile=False, record=False,
+                self_collision=False, xpbd=False, precision=("f32", "f64")):
+    """Common options; scripts with extra options add them to the parser."""
+    parser = argparse.ArgumentParser(description=description)
+    if n is not None:
+        parser.add_argument("--n", type=int, default=n,
+                            help="number of rod particles")
+    if N is not None:
+        parser.add_argument("--N", type=int, default=N,
+                            help="number of mesh cells per side")
+    parser.add_argument("--h", type=float, default=h, help="time step size")
+    parser.add_argument("--max-ite", dest="max_ite", type=int,
+                        default=max_ite,
+                        help="maximum solver iterations per frame")
+    parser.add_argument("--solver", choices=solvers, default=solvers[0],
+                        help="solver variant")
+    parser.add_argument("--arch", choices=("cpu", "gpu"), default=arch)
+    parser.add_argument("--precision", choices=precision, default=precision[0],
+                        help="float type of all fields and kernels"
+                             + (", mixed: f32 iterations on an f64 state"
+                                if "mixed" in precision else ""))
+    if "mixed" in precision:
+        parser.add_argument("--refine", type=int, default=2, metavar="K",
+                            help="mixed precision: the last K iterations of "
+                                 "a frame run in f64")
+    if mesh:
+        parser.add_argument("--mesh", metavar="OBJ",
+                            help="simulate an external 2D mesh instead of "
+                                 "the N x N grid, see scenes.py")
+    if self_collision:
+        parser.add_argument("--self-collision", action="store_true",
+                            help="vertex-vertex and vertex-edge contacts, "
+                                 "see self_collision.py")
+        parser.add_argument("--thickness", type=float,
+                            help="contact distance (default: half the "
+                                 "shortest edge)")
+    if xpbd:
+        parser.add_argument("--compliance", type=float, metavar="ALPHA",
+                            help="XPBD: compliance (inverse stiffness) of "
+                                 "every edge; default: rigid PBD edges")
+        parser.add_argument("--warm-start", type=float, default=0.5,
+                            metavar="F",
+                            help="XPBD: start every frame from F times the "
+                                 "last frame's multipliers (0: from zero; "
+                                 "near 1 the lagged multipliers can ring)")
+    if fuse:
+        parser.add_argument("--fuse", choices=("none", "iteration", "frame"),
+                            default="none",
+                            help="launch one kernel per iteration, or run the "
+                                 "whole frame in one serialized kernel")
+    if control:
+        parser.add_argument("--tol", type=float,
+                            help="stop a frame once the dual residual is below")
+        parser.add_argument("--rtol", type=float,
+                            help="stop a frame once the dual residual dropped "
+                                 "by this factor")
+        parser.add_argument("--budget-ms", type=float,
+                            help="wall-clock budget for the iterations of a "
+                                 "frame, see controller.py")
+    if history:
+        parser.add_argument("--residual-every", type=int, default=0,
+                            metavar="K",
+                            help="keep residuals in a device field and read "
+                                 "them every K frames (0: every iteration)")
+    if profile:
+        parser.add_argument("--profile", metavar="TRACE.json",
+                            help="write a Chrome trace of the phases and "
+                                 "kernels of every frame, see profiling.py")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="keep compiled kernels in an offline cache per "
+                             "configuration, see compile_cache.py")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="compile the kernels before the first frame")
+    if record:
+        parser.add_argument("--record", metavar="DIR",
+                            help="record the positions of every frame for "
+                                 "render_trajectory.py, see trajectory.py")
+        parser.add_argument("--record-frames", type=int, default=2000,
+                            help="frames to record; the GUI closes when "
+                                 "they are recorded")
+    parser.add_argument("--residual-log", metavar="PATH",
+                        help="where scripts that log residuals append them "
+                             "(default: their data/*.bin), see residual_log.py")
+    parser.add_argument("--checkpoint", metavar="PATH",
+                        help="save the simulation state at the end of the run")
+    parser.add_argument("--restore", metavar="PATH",
+                        help="start from a saved state instead of the "
+                             "initial pose, see checkpoint.py")
+    parser.add_argument("--restore-mmap", action="store_true",
+                        help="read the --restore file through a memory map")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window and report throughput")
+    parser.add_argument("--frames", type=int, default=100,
+                        help="frames to simulate in headless mode")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed frames before measuring (JIT compile)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the headless report as one JSON line")
+    return parser
+
+
+def parse_args(*args, **kwargs):
+    return make_parser(*args, **kwargs).parse_args()
+
+
+def real_type(args):
+    """The float type of the fields for --precision (mixed: the state's)."""
+    return ti.f32 if args.precision == "f32" else ti.f64
+
+
+def real_numpy_type(args):
+    """The NumPy dtype of real_type(args), for arrays copied into fields."""
+    return np.float32 if args.precision == "f32" else np.float64
+
+
+def edge_residual(pos, edge, rest_len):
+    """L2 norm of the distance constraints C_i = |x_i0 - x_i1| - l_i."""
+    x = pos.to_numpy()
+    e = edge.to_numpy()
+    dis = np.linalg.norm(x[e[:, 0]] - x[e[:, 1]], axis=1)
+    return float(np.linalg.norm(dis - rest_len.to_numpy()))
+
+
+def benchmark(step, frames, warmup=1, residual=None, reset=None):
+    """
+    Time step(frames) without rendering.
+
+    step(n_frames) advances the simulation and returns the number of solver
+    iterations it ran. residual() is evaluated once after the timed frames,
+    reset() once after the warmup frames to clear per-frame statistics.
+    """
+    start = time.perf_counter()
+    if warmup > 0:
+        step(warmup)
+    ti.sync()
+    warmup_elapsed = time.perf_counter() - start  # mostly JIT compilation
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    iterations = step(frames)
+    ti.sync()
+    elapsed = time.perf_counter() - start
+    report = {
+        "frames": frames,
+        "warmup_seconds": warmup_elapsed,
+        "iterations": iterations,
+        "seconds": elapsed,
+        "frames_per_s": frames / elapsed if elapsed > 0 else float("inf"),
+        "iterations_per_s": iterations / elapsed if elapsed > 0 else float("inf"),
+    }
+    if residual is not None:
+        report["residual"] = residual()
+    return report
+
+
+def run_headless(args, step, residual=None, stats=None, reset=None, **scene):
+    """
+    Benchmark step() and print the report. stats is a callable, or a list of
+    callables, returning dicts of solver counters to add.
+    """
+    report = benchmark(step, args.frames, args.warmup, residual, reset)
+    report = dict(solver=args.solver, h=args.h, max_ite=args.max_ite,
+                  **scene, **report)
+    for extra in stats if isinstance(stats, (list, tuple)) else [stats]:
+        if extra is not None:
+            report.update(extra())
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(" ".join(f"{k}={v:.6g}" if isinstance(v, float) else f"{k}={v}"
+                       for k, v in report.items()))
+    return report
@@ -0,0 +1,22 @@
+"""
+Linear solvers for the rod Schur complement A = G^T G.
+"""
+import numpy as np
+from scipy.linalg import solve_banded
+
+
+def Thomas_solve(A, b):
+    """
+    Exact O(n) solve of a tridiagonal A by banded LU, i.e. the Thomas
+    algorithm with partial pivoting.
+
+    For a chain whose edges are numbered along the rod, edge i only shares
+    particles with edges i - 1 and i + 1, so A is tridiagonal. Entries
+    outside the three central diagonals are ignored.
+    """
+    m = A.shape[0]
+    ab = np.zeros((3, m), b.dtype)
+    ab[0, 1:] = A.diagonal(1)
+    ab[1] = A.diagonal()
+    ab[2, :-1] = A.diagonal(-1)
+    return solve_banded((1, 1), ab, b, check_finite=False)
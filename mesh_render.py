@@ -0,0 +1,38 @@
+"""
+Line-segment rendering of the mesh scripts with cached topology.
+
+The edge index arrays are copied from the device once; every frame only
+downloads the positions and gathers all segment endpoints with a single
+fancy-indexing operation. Meshes with more edges (or vertices) than the
+budget are drawn with an evenly strided subset.
+"""
+import numpy as np
+
+
+def _stride(count, budget):
+    return max(-(-count // budget), 1) if budget else 1
+
+
+class MeshRenderer:
+    def __init__(self, gui, positions, edge_indices, max_edges=20000,
+                 max_vertices=5000, line_radius=2, line_color=0x0000FF,
+                 vertex_radius=6, vertex_color=0xffaa33):
+        self.gui = gui
+        self.positions = positions
+        edges = edge_indices.to_numpy()
+        edges = edges[::_stride(len(edges), max_edges)]
+        self.begin = np.ascontiguousarray(edges[:, 0])
+        self.end = np.ascontiguousarray(edges[:, 1])
+        self.vertices = slice(None, None,
+                              _stride(positions.shape[0], max_vertices))
+        self.line_radius, self.line_color = line_radius, line_color
+        self.vertex_radius, self.vertex_color = vertex_radius, vertex_color
+
+    def draw(self):
+        """Draw edges and vertices, return the downloaded positions."""
+        poses = self.positions.to_numpy()
+        self.gui.lines(poses[self.begin], poses[self.end],
+                       radius=self.line_radius, color=self.line_color)
+        self.gui.circles(poses[self.vertices], radius=self.vertex_radius,
+                         color=self.vertex_color)
+        return poses
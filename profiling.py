@@ -0,0 +1,171 @@
+"""
+Opt-in timeline of the solver phases and Taichi kernels.
+
+With --profile TRACE.json a script times every frame, every named phase
+and every kernel launch, and writes them at exit as a Chrome trace (open
+it in chrome://tracing or https://ui.perfetto.dev) together with the time
+each phase and kernel took in every frame:
+
+    profiler = Profiler.from_args(args)
+
+    @profiler.frame
+    def update(h):
+        seme_euler(h)
+        with profiler.phase("assemble"):
+            G, A = pattern.assemble(gradient.to_numpy())
+        ...
+
+    profiler.wrap_kernels(globals())  # once the kernels are defined
+    profiler.wrap_kernels(helper)     # kernels of a ti.data_oriented object
+
+Everything recorded after a frame starts, up to the start of the next one,
+counts towards that frame, so rendering and file I/O of the GUI loop land
+in the frame they draw. Kernels and phases wait for the device before they
+stop their clock, otherwise their time is charged to whatever reads from
+the device next; this also stops launches from overlapping, so profile and
+benchmark in separate runs. Without --profile the decorators return the
+functions unchanged, phase() returns a shared do-nothing context and
+wrap_kernels() leaves the kernels alone.
+"""
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import taichi as ti
+
+import closing
+
+_DISABLED = contextlib.nullcontext()
+
+
+class Profiler:
+    def __init__(self, path=None, sync=True, max_events=1 << 20):
+        self.path = path
+        self.enabled = path is not None
+        self.sync = sync
+        self.max_events = max_events  # later events are only aggregated
+        self.events = []  # (name, category, start, duration) in seconds
+        self.frames = []  # {name: seconds} of every frame
+        self.calls = {}
+        self.current = None
+        self.dropped = 0
+        self.origin = time.perf_counter()
+        if self.enabled:
+            closing.register(self.save)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, "profile", None))
+
+    def _record(self, name, category, start, end):
+        duration = end - start
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0.0) + duration
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if len(self.events) < self.max_events:
+            self.events.append((name, category, start, duration))
+        else:
+            self.dropped += 1
+
+    @contextlib.contextmanager
+    def _timed(self, name, category):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                ti.sync()
+            self._record(name, category, start, time.perf_counter())
+
+    def phase(self, name):
+        """Context manager timing a block of host code."""
+        if not self.enabled:
+            return _DISABLED
+        return self._timed(name, "phase")
+
+    def timed(self, name=None):
+        """Decorator timing every call of a function as a phase."""
+        def decorate(fn):
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self._timed(name or fn.__name__, "phase"):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def frame(self, fn):
+        """Decorator for the function advancing the simulation by a frame."""
+        if not self.enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if self.current is not None:
+                self.frames.append(self.current)
+            self.current = {}
+            with self._timed("frame", "frame"):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def wrap_kernels(self, namespace):
+        """Time every Taichi kernel of a module's globals() or an object."""
+        if not self.enabled or namespace is None:
+            return
+        if not isinstance(namespace, dict):  # bound kernels of an instance
+            for name, value in vars(type(namespace)).items():
+                if getattr(value, "_is_wrapped_kernel", False):
+                    setattr(namespace, name,
+                            self._kernel(name, getattr(namespace, name)))
+            return
+        for name, value in list(namespace.items()):
+            if getattr(value, "_is_wrapped_kernel", False):
+                namespace[name] = self._kernel(name, value)
+
+    def _kernel(self, name, kernel):
+        @functools.wraps(kernel)
+        def launch(*args, **kwargs):
+            with self._timed(name, "kernel"):
+                return kernel(*args, **kwargs)
+        return launch
+
+    def summary(self):
+        """Per-frame milliseconds of every phase and kernel."""
+        frames = self.frames + ([self.current] if self.current else [])
+        names = sorted({name for frame in frames for name in frame})
+        summary = {}
+        for name in names:
+            ms = 1e3 * np.array([frame.get(name, 0.0) for frame in frames])
+            summary[name] = {"mean_ms": float(ms.mean()),
+                             "max_ms": float(ms.max()),
+                             "total_ms": float(ms.sum()),
+                             "calls": self.calls[name]}
+        return frames, summary
+
+    def save(self, path=None):
+        path = path or self.path
+        frames, summary = self.summary()
+        pid = os.getpid()
+        trace = {
+            "traceEvents": [
+                {"name": name, "cat": category, "ph": "X", "pid": pid,
+                 "tid": 0, "ts": 1e6 * (start - self.origin),
+                 "dur": 1e6 * duration}
+                for name, category, start, duration in self.events],
+            "displayTimeUnit": "ms",
+            "frames": [{name: 1e3 * s for name, s in frame.items()}
+                       for frame in frames],
+            "summary": summary,
+            "droppedEvents": self.dropped,
+        }
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        # stderr, so the --json report stays the last line on stdout
+        print(f"profile of {len(frames)} frames written to {path}",
+              file=sys.stderr)
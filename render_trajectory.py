@@ -0,0 +1,67 @@
+"""
+Render a recorded trajectory (see trajectory.py) to PNG frames.
+
+The frames are split into contiguous chunks that the workers draw with
+their own off-screen GUI, reading the positions from the memory-mapped
+trajectory, so no display is needed and the simulation never waits for
+image encoding:
+
+    python render_trajectory.py traj --out video --workers 8
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import taichi as ti
+
+from trajectory import load_trajectory
+
+
+def render(job):
+    directory, out, first, last, res = job
+    positions, edges, meta = load_trajectory(directory)
+    style = meta["style"]
+    gui = ti.GUI("trajectory", res=res, show_gui=False)
+    for k in range(first, last):
+        x = positions[k]
+        gui.lines(x[edges[:, 0]], x[edges[:, 1]],
+                  radius=style.get("line_radius", 4),
+                  color=style.get("line_color", 0x00FF00))
+        gui.circles(x, radius=style.get("vertex_radius", 5),
+                    color=style.get("vertex_color", 0xFF0000))
+        gui.show(os.path.join(out, f"frame_{k:05d}.png"))
+    return last - first
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trajectory")
+    parser.add_argument("--out", default="video")
+    parser.add_argument("--res", type=int, help="image size in pixels "
+                                                "(default: the script's)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunks", type=int, default=4,
+                        help="chunks of frames per worker")
+    args = parser.parse_args()
+
+    positions, _, meta = load_trajectory(args.trajectory)
+    res = args.res or meta["style"].get("res", 500)
+    os.makedirs(args.out, exist_ok=True)
+    bounds = np.linspace(0, len(positions), args.workers * args.chunks + 1)
+    bounds = np.unique(bounds.astype(int))
+    jobs = [(args.trajectory, args.out, int(a), int(b), res)
+            for a, b in zip(bounds[:-1], bounds[1:])]
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.workers) as pool:
+        frames = sum(pool.imap_unordered(render, jobs))
+    elapsed = time.perf_counter() - start
+    print(f"{frames} frames written to {args.out} in {elapsed:.2f}s "
+          f"({frames / elapsed:.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    main()
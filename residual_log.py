@@ -0,0 +1,164 @@
+"""
+Buffered binary residual logging.
+
+ResidualRecorder collects (frame, iteration, residual) triples into
+preallocated arrays and appends them to a binary file in batches. The
+residual is always the dual residual norm |C|; solvers that compute the
+sum of squares pass squared=True and the recorder takes the root. Every
+batch is one block:
+
+    uint32 count | uint16 len(tag) | tag (utf-8)
+    int32 frame[count] | int32 iteration[count] | float64 residual[count]
+
+so runs of different solvers can share a file. load_residuals() reads a
+whole file back into columns:
+
+    python residual_log.py data/Jacobi.bin            # summary per solver
+    python residual_log.py data/Jacobi.bin --txt a.txt  # old text format
+"""
+import os
+import struct
+
+import numpy as np
+
+import closing
+
+MAGIC = b"PBDRES1\n"
+_HEADER = struct.Struct("<IH")
+
+
+class ResidualRecorder:
+    def __init__(self, path, tag, capacity=1 << 16, squared=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.tag = tag.encode()
+        self.frames = np.empty(capacity, np.int32)
+        self.iterations = np.empty(capacity, np.int32)
+        self.residuals = np.empty(capacity, np.float64)
+        self.squared = squared  # residuals come in as sums of squares
+        self.count = 0
+        self.frame = -1
+        closing.register(self.close)
+
+    def new_frame(self):
+        self.frame += 1
+
+    def record(self, iteration, residual, frame=None):
+        if self.count == len(self.residuals):
+            self.flush()
+        self.frames[self.count] = self.frame if frame is None else frame
+        self.iterations[self.count] = iteration
+        self.residuals[self.count] = residual
+        self.count += 1
+
+    def record_frame(self, residuals):
+        """Start a new frame and record its residual of every iteration."""
+        self.new_frame()
+        for iteration, residual in enumerate(residuals):
+            self.record(iteration, residual)
+
+    def flush(self):
+        if self.count == 0 or self.file.closed:
+            return
+        k = self.count
+        self.file.write(_HEADER.pack(k, len(self.tag)) + self.tag)
+        self.file.write(self.frames[:k].tobytes())
+        self.file.write(self.iterations[:k].tobytes())
+        residuals = self.residuals[:k]
+        if self.squared:
+            residuals = np.sqrt(residuals)
+        self.file.write(residuals.tobytes())
+        self.file.flush()
+        self.count = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class DeviceResidualHistory:
+    """
+    Residuals kept on the device instead of returned by a kernel.
+
+    field is a (K, max_ite) Taichi field the solver kernels write the
+    residual of frame slot `slot` and iteration i into. It is read back and
+    handed to the recorder once every K frames, so the iteration loop never
+    waits for the device.
+    """
+
+    def __init__(self, field, recorder=None, transform=None):
+        self.field = field
+        self.recorder = recorder
+        self.transform = transform
+        self.frame = 0
+        self.slot = 0
+        self.last = None  # residuals of the most recently read frame
+        self.counts = [field.shape[1]] * field.shape[0]
+        closing.register(self.flush)
+
+    def end_frame(self, iterations=None):
+        """iterations: how many rows of the slot the frame filled."""
+        self.counts[self.slot] = (self.field.shape[1] if iterations is None
+                                  else iterations)
+        self.slot += 1
+        if self.slot == self.field.shape[0]:
+            self.flush()
+
+    def flush(self):
+        if self.slot == 0:
+            return
+        rows = self.field.to_numpy()[:self.slot]
+        if self.transform is not None:
+            rows = self.transform(rows)
+        first = self.frame
+        if self.recorder is not None:
+            for k, row in enumerate(rows):
+                for iteration, residual in enumerate(row[:self.counts[k]]):
+                    self.recorder.record(iteration, residual, first + k)
+        self.last = rows[-1][:self.counts[self.slot - 1]]
+        self.frame += self.slot
+        self.slot = 0
+
+
+def load_residuals(path):
+    """Return a dict of columns: frame, iteration, residual and solver."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a residual log")
+    offset = len(MAGIC)
+    columns = {"frame": [], "iteration": [], "residual": [], "solver": []}
+    while offset < len(data):
+        k, tag_len = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        tag = data[offset:offset + tag_len].decode()
+        offset += tag_len
+        for name, dtype in (("frame", np.int32), ("iteration", np.int32),
+                            ("residual", np.float64)):
+            columns[name].append(np.frombuffer(data, dtype, k, offset))
+            offset += k * np.dtype(dtype).itemsize
+        columns["solver"].append(np.full(k, tag))
+    return {name: np.concatenate(blocks) if blocks else np.empty(0)
+            for name, blocks in columns.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect a residual log")
+    parser.add_argument("path")
+    parser.add_argument("--txt", help="write residuals one per line")
+    args = parser.parse_args()
+    log = load_residuals(args.path)
+    for tag in np.unique(log["solver"]):
+        mask = log["solver"] == tag
+        print(f"{tag}: {mask.sum()} residuals, "
+              f"{len(np.unique(log['frame'][mask]))} frames, "
+              f"last {log['residual'][mask][-1]:.6g}")
+    if args.txt:
+        np.savetxt(args.txt, log["residual"])
@@ -0,0 +1,118 @@
+"""
+Scene builders and a cached loader for external 2D meshes.
+
+grid() and rod() generate the same topology as init_pos()/init_edge() of
+the tutorial scripts at any size, directly in NumPy. load_mesh() reads a
+2D Wavefront OBJ file ("v x y", "l a b" segments, "f a b c ..." polygons
+whose sides become edges) and stores positions, unique edges and rest
+lengths as .npy files in a cache directory. Later loads memory-map those
+files, skipping both the text parsing and the rest length pass.
+
+    python scenes.py grid 1000 cloth_1000.obj
+    python 6_pbd_mesh_jacobi.py --mesh cloth_1000.obj
+"""
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+Scene = collections.namedtuple("Scene", "positions edges rest_len")
+
+CACHE_VERSION = 1
+
+
+def rest_lengths(positions, edges):
+    return np.linalg.norm(positions[edges[:, 0]] - positions[edges[:, 1]],
+                          axis=1).astype(np.float32)
+
+
+def rod(n, spacing=0.1, origin=(0.4, 0.5)):
+    positions = np.zeros((n, 2), np.float32)
+    positions[:, 0] = np.arange(n) * spacing
+    positions += np.asarray(origin, np.float32)
+    edges = np.stack([np.arange(n - 1), np.arange(1, n)], 1).astype(np.int32)
+    return Scene(positions, edges, rest_lengths(positions, edges))
+
+
+def grid(N, size=0.5, origin=(0.25, 0.25)):
+    """(N+1)^2 vertices, edges numbered like init_edge() in the mesh scripts."""
+    i, j = np.meshgrid(np.arange(N + 1), np.arange(N + 1), indexing="ij")
+    positions = (np.stack([i, j], -1).reshape(-1, 2) * (size / N)
+                 + np.asarray(origin)).astype(np.float32)
+    a = (i * (N + 1) + j)[:, :N].ravel()  # edges along j, index i * N + j
+    first = np.stack([a, a + 1], 1)
+    a = (i * (N + 1) + j)[:N, :].T.ravel()  # edges along i, index i + j * N
+    second = np.stack([a, a + N + 1], 1)
+    edges = np.concatenate([first, second]).astype(np.int32)
+    return Scene(positions, edges, rest_lengths(positions, edges))
+
+
+def top_corners(positions):
+    """Top-left and top-right vertices, the pinned points of the grid."""
+    x, y = positions[:, 0], positions[:, 1]
+    return [int(np.argmax(y - x)), int(np.argmax(x + y))]
+
+
+def save_obj(scene, path):
+    with open(path, "w") as f:
+        for x, y in scene.positions.tolist():
+            f.write(f"v {x} {y} 0\n")
+        for a, b in (scene.edges + 1).tolist():
+            f.write(f"l {a} {b}\n")
+
+
+def parse_obj(path):
+    vertices, edges = [], []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "v":
+                vertices.append((float(parts[1]), float(parts[2])))
+            elif parts[0] in ("l", "f"):
+                ids = [int(p.split("/")[0]) for p in parts[1:]]
+                ids = [k - 1 if k > 0 else len(vertices) + k for k in ids]
+                if parts[0] == "f":
+                    ids.append(ids[0])
+                edges.extend(zip(ids[:-1], ids[1:]))
+    positions = np.asarray(vertices, np.float32).reshape(-1, 2)
+    edges = np.sort(np.asarray(edges, np.int64).reshape(-1, 2), axis=1)
+    edges = np.unique(edges, axis=0).astype(np.int32)  # shared polygon sides
+    return Scene(positions, edges, rest_lengths(positions, edges))
+
+
+def _cache_dir(path, cache_root):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{CACHE_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    if cache_root is None:
+        cache_root = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                  ".scene_cache")
+    return os.path.join(cache_root, f"{os.path.basename(path)}-{digest}")
+
+
+def load_mesh(path, cache_root=None):
+    """Load an OBJ mesh; the processed arrays come back memory-mapped."""
+    directory = _cache_dir(path, cache_root)
+    files = [os.path.join(directory, f"{name}.npy") for name in Scene._fields]
+    if not all(os.path.exists(f) for f in files):
+        scene = parse_obj(path)
+        os.makedirs(directory, exist_ok=True)
+        for f, array in zip(files, scene):
+            np.save(f + ".tmp.npy", array)
+            os.replace(f + ".tmp.npy", f)
+    return Scene(*(np.load(f, mmap_mode="r") for f in files))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write a generated scene")
+    parser.add_argument("kind", choices=("grid", "rod"))
+    parser.add_argument("size", type=int, help="N for grids, n for rods")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    save_obj(grid(args.size) if args.kind == "grid" else rod(args.size),
+             args.path)
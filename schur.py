@@ -0,0 +1,276 @@
+"""
+Sparse assembly of the constraint gradient G and the Schur complement
+A = G^T G used by the rod solvers in 2_2, 2_3 and 2_4, optionally shifted
+by the XPBD compliances alpha / h^2 on its diagonal, and the matrix-free
+solve of --matrix-free in 2_2 and 2_3 that never assembles them.
+
+The sparsity pattern only depends on the topology, so it is computed once
+from the edge list. Every iteration only refills the values from the
+per-edge gradient directions g with vectorized NumPy, no Python loops.
+"""
+import numpy as np
+import scipy.sparse as sparse
+import taichi as ti
+
+
+class SchurPattern:
+    """
+    Cached CSR patterns of G (2 * n_free, n_edges) and A (n_edges, n_edges).
+
+    Column i of G holds +g_i at the rows of edge[i][0] and -g_i at the rows
+    of edge[i][1]. Rows of fixed particles are dropped, so with the default
+    fixed=(0,) particle p owns rows 2 * (p - 1) and 2 * (p - 1) + 1, which is
+    the layout correct() expects.
+    """
+
+    def __init__(self, edges, n_particles, fixed=(0,)):
+        edges = np.asarray(edges, np.int64)
+        n_edges = len(edges)
+        free = np.setdiff1d(np.arange(n_particles), fixed)
+        row_of = np.full(n_particles, -1, np.int64)
+        row_of[free] = np.arange(len(free))
+        self.n_edges = n_edges
+        self.n_free = len(free)
+
+        # incidences (edge, particle, sign) of free particles
+        inc_edge = np.repeat(np.arange(n_edges), 2)
+        inc_sign = np.tile([1.0, -1.0], n_edges)
+        inc_row = row_of[edges.ravel()]
+        keep = inc_row >= 0
+        inc_edge, inc_sign, inc_row = inc_edge[keep], inc_sign[keep], inc_row[keep]
+
+        # G: one entry per incidence and component, rows are unique per column
+        g_edge = np.repeat(inc_edge, 2)
+        g_comp = np.tile([0, 1], len(inc_edge))
+        g_sign = np.repeat(inc_sign, 2)
+        g_rows = 2 * np.repeat(inc_row, 2) + g_comp
+        perm = np.lexsort((g_edge, g_rows))
+        self._g_edge, self._g_comp = g_edge[perm], g_comp[perm]
+        self._g_sign = g_sign[perm]
+        self._g_indices = g_edge[perm].astype(np.int32)
+        self._g_indptr = np.zeros(2 * self.n_free + 1, np.int32)
+        np.cumsum(np.bincount(g_rows, minlength=2 * self.n_free),
+                  out=self._g_indptr[1:])
+
+        # A: every pair of incidences at the same particle contributes
+        # sign_a * sign_b * g_a . g_b to entry (edge_a, edge_b)
+        order = np.argsort(inc_row, kind="stable")
+        p_row, p_edge, p_sign = inc_row[order], inc_edge[order], inc_sign[order]
+        starts = np.searchsorted(p_row, p_row, "left")
+        deg = np.searchsorted(p_row, p_row, "right") - starts
+        a = np.repeat(np.arange(len(p_row)), deg)
+        offset = np.arange(len(a)) - np.repeat(np.cumsum(deg) - deg, deg)
+        b = np.repeat(starts, deg) + offset
+        self._a_i, self._a_j = p_edge[a], p_edge[b]
+        self._a_sign = p_sign[a] * p_sign[b]
+        keys, self._a_slot = np.unique(self._a_i * n_edges + self._a_j,
+                                       return_inverse=True)
+        self._a_slot = self._a_slot.ravel()
+        self._a_indices = (keys % n_edges).astype(np.int32)
+        self._a_indptr = np.zeros(n_edges + 1, np.int32)
+        np.cumsum(np.bincount(keys // n_edges, minlength=n_edges),
+                  out=self._a_indptr[1:])
+        self._a_diag = np.flatnonzero(keys // n_edges == keys % n_edges)
+        self._a_diag_row = keys[self._a_diag] // n_edges
+
+    def assemble_G(self, g):
+        data = self._g_sign * g[self._g_edge, self._g_comp]
+        return sparse.csr_matrix(
+            (data.astype(g.dtype), self._g_indices, self._g_indptr),
+            shape=(2 * self.n_free, self.n_edges))
+
+    def assemble_A(self, g, shift=None):
+        dots = np.einsum("ij,ij->i", g[self._a_i], g[self._a_j])
+        data = np.bincount(self._a_slot, weights=self._a_sign * dots,
+                           minlength=len(self._a_indices))
+        if shift is not None:
+            data[self._a_diag] += np.broadcast_to(
+                shift, (self.n_edges,))[self._a_diag_row]
+        return sparse.csr_matrix(
+            (data.astype(g.dtype), self._a_indices, self._a_indptr),
+            shape=(self.n_edges, self.n_edges))
+
+    def assemble(self, g, shift=None):
+        """Return (G, A + diag(shift)) for the (n_edges, 2) directions g."""
+        return self.assemble_G(g), self.assemble_A(g, shift)
+
+
+@ti.data_oriented
+class MatrixFreeSchur:
+    """
+    The Schur complement solve of a rod kept on the device.
+
+    G·λ and G^T·x are evaluated edge by edge from edge and the per-edge
+    gradient directions, the entries of A = G^T G (plus the compliances on
+    its diagonal with xpbd) from the two gradients they couple, so nothing
+    is assembled or copied to the host. solve() runs one iteration:
+
+        λ = A^-1 (-C)       Jacobi, or Thomas sweeps with tridiag
+        λ += coarse(b - Aλ) with coarse, pairs of edges as in 2_3
+        x += 0.8 G·λ        and multiplier += 0.8 λ with xpbd
+
+    one kernel per step; iteration() is the same as a ti.func, for scripts
+    that fuse it with the constraint evaluation into one launch.
+    """
+
+    def __init__(self, pos, edge, inv_mass, gradient, constraint,
+                 compliance=None, multiplier=None, xpbd=False):
+        self.n = pos.shape[0]
+        self.pos, self.edge, self.inv_mass = pos, edge, inv_mass
+        self.gradient, self.constraint = gradient, constraint
+        self.compliance, self.multiplier = compliance, multiplier
+        self.xpbd = xpbd
+        self.real = real = constraint.dtype
+        self.lam = ti.field(real, self.n - 1)
+        self.dx = ti.Vector.field(2, real, self.n)  # G·λ per particle
+        self.cp = ti.field(real, self.n - 1)  # Thomas sweep coefficients
+        self.dp = ti.field(real, self.n - 1)
+        self.r_lam = ti.field(real, self.n - 1)  # b - A·λ
+
+    @ti.func
+    def A_entry(self, i, j):
+        # sum over free particles shared by edges i and j of ±g_i·g_j
+        a = ti.cast(0.0, self.real)
+        for s in ti.static(range(2)):
+            for t in ti.static(range(2)):
+                p = self.edge[i][s]
+                if p == self.edge[j][t] and self.inv_mass[p] != 0.0:
+                    a += ((1 - 2 * s) * (1 - 2 * t)
+                          * self.gradient[i].dot(self.gradient[j]))
+        if ti.static(self.xpbd):
+            if i == j:
+                a += self.compliance[i]
+        return a
+
+    @ti.func
+    def jacobi_edge(self, i):
+        self.lam[i] = -self.constraint[i] / self.A_entry(i, i)
+
+    @ti.func
+    def thomas_sweeps(self):
+        # serial, call it from a loop of one iteration
+        m = self.n - 1
+        for i in range(m):
+            a, c = ti.cast(0.0, self.real), ti.cast(0.0, self.real)
+            if i > 0:
+                a = self.A_entry(i, i - 1)
+            if i < m - 1:
+                c = self.A_entry(i, i + 1)
+            den = self.A_entry(i, i)
+            rhs = -self.constraint[i]
+            if i > 0:
+                den -= a * self.cp[i - 1]
+                rhs -= a * self.dp[i - 1]
+            self.cp[i] = c / den
+            self.dp[i] = rhs / den
+        self.lam[m - 1] = self.dp[m - 1]
+        for k in range(1, m):
+            i = m - 1 - k
+            self.lam[i] = self.dp[i] - self.cp[i] * self.lam[i + 1]
+
+    @ti.func
+    def apply_G_edge(self, i):
+        idx0, idx1 = self.edge[i]
+        if self.inv_mass[idx0] != 0.0:
+            self.dx[idx0] += self.lam[i] * self.gradient[i]
+        if self.inv_mass[idx1] != 0.0:
+            self.dx[idx1] -= self.lam[i] * self.gradient[i]
+
+    @ti.func
+    def residual_edge(self, i):
+        # r = b - G^T (G·λ)
+        idx0, idx1 = self.edge[i]
+        self.r_lam[i] = -self.constraint[i] - self.gradient[i].dot(
+            self.dx[idx0] - self.dx[idx1])
+        if ti.static(self.xpbd):
+            self.r_lam[i] -= self.compliance[i] * self.lam[i]
+
+    @ti.func
+    def coarse_pair(self, k):
+        c = self.r_lam[2 * k] + self.r_lam[2 * k + 1]
+        denomitor = 4 - 2 * self.gradient[2 * k].dot(self.gradient[2 * k + 1])
+        if ti.static(self.xpbd):
+            denomitor += self.compliance[2 * k] + self.compliance[2 * k + 1]
+        self.lam[2 * k] += c / denomitor
+        self.lam[2 * k + 1] += c / denomitor
+
+    @ti.func
+    def correct_particle(self, i):
+        self.pos[i] += 0.8 * self.dx[i]
+
+    @ti.func
+    def accumulate_edge(self, i):
+        self.multiplier[i] += 0.8 * self.lam[i]
+
+    @ti.func
+    def apply_G_loops(self):
+        for i in range(self.n):
+            self.dx[i] = ti.Vector([0.0, 0.0])
+        for i in range(self.n - 1):
+            self.apply_G_edge(i)
+
+    @ti.func
+    def iteration(self, tridiag: ti.template(), coarse: ti.template()):
+        # the loops of solve(), one after the other
+        if ti.static(tridiag):
+            for _ in range(1):
+                self.thomas_sweeps()
+        else:
+            for i in range(self.n - 1):
+                self.jacobi_edge(i)
+        if ti.static(coarse):
+            self.apply_G_loops()
+            for i in range(self.n - 1):
+                self.residual_edge(i)
+            for k in range((self.n - 1) // 2):
+                self.coarse_pair(k)
+        self.apply_G_loops()
+        for i in range(self.n):
+            self.correct_particle(i)
+        if ti.static(self.xpbd):
+            for i in range(self.n - 1):
+                self.accumulate_edge(i)
+
+    @ti.kernel
+    def jacobi_lambda(self):
+        for i in range(self.n - 1):
+            self.jacobi_edge(i)
+
+    @ti.kernel
+    def thomas_lambda(self):
+        for _ in range(1):  # a single outer iteration runs the sweeps serially
+            self.thomas_sweeps()
+
+    @ti.kernel
+    def apply_G(self):
+        self.apply_G_loops()
+
+    @ti.kernel
+    def residual_GT(self):
+        for i in range(self.n - 1):
+            self.residual_edge(i)
+
+    @ti.kernel
+    def coarse_correct(self):
+        for k in range((self.n - 1) // 2):
+            self.coarse_pair(k)
+
+    @ti.kernel
+    def correct_dx(self):
+        for i in range(self.n):
+            self.correct_particle(i)
+        if ti.static(self.xpbd):
+            for i in range(self.n - 1):
+                self.accumulate_edge(i)
+
+    def solve(self, tridiag=False, coarse=False):
+        if tridiag:
+            self.thomas_lambda()
+        else:
+            self.jacobi_lambda()
+        if coarse:
+            self.apply_G()
+            self.residual_GT()
+            self.coarse_correct()
+        self.apply_G()
+        self.correct_dx()
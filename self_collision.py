@@ -0,0 +1,163 @@
+"""
+Vertex-vertex and vertex-edge self-collision of the cloth meshes.
+
+Once per frame, after the prediction step, find_pairs() rebuilds two
+spatial hashes (vertices and edge midpoints, see spatial_hash.py) and
+collects every vertex pair and vertex-edge pair within 1.5 times the
+cloth thickness, looking only at the 3 x 3 cells around each vertex, so the
+broad phase is linear in the number of vertices. solve() is then called
+in the solver's iteration loop like another constraint pass: every pair
+closer than the thickness is pushed apart along its normal, weighted by
+the inverse masses as the distance constraints are. Pairs beyond the
+pair buffer are dropped and counted.
+
+    contacts = SelfCollision(positions, inv_mass, edge_indices, rest_len)
+    semi_euler(h)
+    contacts.find_pairs()
+    for ite in range(max_ite):
+        solve_constraints()
+        contacts.solve()
+        collision()
+"""
+import numpy as np
+import taichi as ti
+
+from spatial_hash import SpatialHash
+
+
+@ti.data_oriented
+class SelfCollision:
+    def __init__(self, positions, inv_mass, edges, rest_len, thickness=None,
+                 max_pairs=None, relax=0.9, max_stretch=1.5):
+        lengths = rest_len.to_numpy()
+        self.positions = positions
+        self.inv_mass = inv_mass
+        self.edges = edges
+        self.nv = positions.shape[0]
+        self.ne = edges.shape[0]
+        # below half an edge, so a flat cloth has no contacts of its own
+        self.thickness = float(thickness or 0.5 * lengths.min())
+        self.relax = relax
+        self.max_pairs = max_pairs or 8 * self.nv
+        self.search = 1.5 * self.thickness
+        self.vertex_hash = SpatialHash(self.nv, self.search)
+        # edges are binned by their midpoint, the cells must cover half an
+        # edge (stretched by up to max_stretch) on top of the search radius
+        self.edge_hash = SpatialHash(
+            self.ne, self.search + 0.5 * max_stretch * float(lengths.max()))
+        self.midpoints = ti.Vector.field(2, positions.dtype, self.ne)
+        self.vv = ti.Vector.field(2, ti.i32, self.max_pairs)
+        self.ve = ti.Vector.field(2, ti.i32, self.max_pairs)
+        self.found = ti.field(ti.i32, 2)  # vertex-vertex, vertex-edge
+        self.frames = 0
+        self.pairs = np.zeros(2, np.int64)
+        self.overflow = 0
+
+    @ti.kernel
+    def _midpoints(self):
+        for e in range(self.ne):
+            a, b = self.edges[e]
+            self.midpoints[e] = 0.5 * (self.positions[a] + self.positions[b])
+
+    @ti.func
+    def _seen(self, grid: ti.template(), c, k, m: ti.template()):
+        # distinct cells can hash to one slot, visit every slot once
+        seen = False
+        for q in ti.static(range(m)):
+            if grid.slot(c + ti.Vector([q // 3 - 1, q % 3 - 1])) == k:
+                seen = True
+        return seen
+
+    @ti.func
+    def _closest(self, x, e):
+        a, b = self.edges[e]
+        xa, xb = self.positions[a], self.positions[b]
+        ab = xb - xa
+        t = ti.min(ti.max((x - xa).dot(ab) / ab.dot(ab), 0.0), 1.0)
+        return a, b, t, x - (xa + t * ab)
+
+    @ti.func
+    def _vertex_pairs(self, i, x):
+        grid = self.vertex_hash
+        c = grid.cell(x)
+        for m in ti.static(range(9)):
+            k = grid.slot(c + ti.Vector([m // 3 - 1, m % 3 - 1]))
+            if not self._seen(grid, c, k, m):
+                for s in range(grid.cell_start[k], grid.cell_start[k + 1]):
+                    j = grid.entries[s]
+                    d = x - self.positions[j]
+                    if (j > i and d.norm() < self.search
+                            and self.inv_mass[i] + self.inv_mass[j] > 0.0):
+                        p = ti.atomic_add(self.found[0], 1)
+                        if p < self.max_pairs:
+                            self.vv[p] = ti.Vector([i, j])
+
+    @ti.func
+    def _edge_pairs(self, i, x):
+        grid = self.edge_hash
+        c = grid.cell(x)
+        for m in ti.static(range(9)):
+            k = grid.slot(c + ti.Vector([m // 3 - 1, m % 3 - 1]))
+            if not self._seen(grid, c, k, m):
+                for s in range(grid.cell_start[k], grid.cell_start[k + 1]):
+                    e = grid.entries[s]
+                    a, b, t, d = self._closest(x, e)
+                    if (a != i and b != i and d.norm() < self.search
+                            and self.inv_mass[i] + self.inv_mass[a]
+                            + self.inv_mass[b] > 0.0):
+                        p = ti.atomic_add(self.found[1], 1)
+                        if p < self.max_pairs:
+                            self.ve[p] = ti.Vector([i, e])
+
+    @ti.kernel
+    def _find(self):
+        self.found[0] = 0
+        self.found[1] = 0
+        for i in range(self.nv):
+            self._vertex_pairs(i, self.positions[i])
+            self._edge_pairs(i, self.positions[i])
+
+    def find_pairs(self):
+        """Rebuild the hashes and collect the pairs near contact."""
+        self.vertex_hash.build(self.positions)
+        self._midpoints()
+        self.edge_hash.build(self.midpoints)
+        self._find()
+        found = self.found.to_numpy()
+        self.frames += 1
+        self.pairs += np.minimum(found, self.max_pairs)
+        self.overflow += int(np.maximum(found - self.max_pairs, 0).sum())
+
+    @ti.kernel
+    def solve(self):
+        for p in range(ti.min(self.found[0], self.max_pairs)):
+            i, j = self.vv[p]
+            d = self.positions[i] - self.positions[j]
+            dist = d.norm()
+            if 0.0 < dist < self.thickness:
+                n = d / dist
+                s = self.relax * (self.thickness - dist) / (
+                    self.inv_mass[i] + self.inv_mass[j])
+                self.positions[i] += self.inv_mass[i] * s * n
+                self.positions[j] -= self.inv_mass[j] * s * n
+        for p in range(ti.min(self.found[1], self.max_pairs)):
+            i, e = self.ve[p]
+            a, b, t, d = self._closest(self.positions[i], e)
+            dist = d.norm()
+            w = (self.inv_mass[i] + (1 - t) ** 2 * self.inv_mass[a]
+                 + t ** 2 * self.inv_mass[b])
+            if 0.0 < dist < self.thickness and w > 0.0:
+                n = d / dist
+                s = self.relax * (self.thickness - dist) / w
+                self.positions[i] += self.inv_mass[i] * s * n
+                self.positions[a] -= (1 - t) * self.inv_mass[a] * s * n
+                self.positions[b] -= t * self.inv_mass[b] * s * n
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            "thickness": self.thickness,
+            "vv_pairs_mean": float(self.pairs[0] / frames),
+            "ve_pairs_mean": float(self.pairs[1] / frames),
+            "pair_overflow": self.overflow,
+        }
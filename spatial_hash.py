@@ -0,0 +1,84 @@
+"""
+Uniform-grid spatial hash for neighbour queries on the device.
+
+Points are binned into square cells of cell_size; the unbounded cell
+coordinates are hashed into a table of about twice as many slots as there
+are points. build() is a parallel counting sort:
+
+    count    every point adds one to its slot (atomic)
+    scan     exclusive prefix sum of the counts, per block of slots in
+             parallel, then over the block sums, giving cell_start
+    scatter  every point takes the next free index of its slot range
+
+so entries[cell_start[k]:cell_start[k + 1]] are the points of slot k and
+the whole rebuild is linear in the number of points and slots. Distinct
+cells can share a slot, callers filter candidates by distance anyway.
+"""
+import taichi as ti
+
+
+@ti.data_oriented
+class SpatialHash:
+    def __init__(self, capacity, cell_size, table_size=None, block=256):
+        self.capacity = capacity
+        self.cell_size = cell_size
+        self.block = block
+        size = table_size or 2 * capacity
+        self.table_size = -(-size // block) * block
+        self.blocks = self.table_size // block
+        self.cell_count = ti.field(ti.i32, self.table_size)
+        self.cell_start = ti.field(ti.i32, self.table_size + 1)
+        self.block_sum = ti.field(ti.i32, self.blocks)
+        self.point_slot = ti.field(ti.i32, capacity)
+        self.entries = ti.field(ti.i32, capacity)
+
+    @ti.func
+    def cell(self, p):
+        return ti.cast(ti.floor(p / self.cell_size), ti.i32)
+
+    @ti.func
+    def slot(self, c):
+        k = (c[0] * 73856093) ^ (c[1] * 19349663)
+        return (k % self.table_size + self.table_size) % self.table_size
+
+    @ti.kernel
+    def _count(self, points: ti.template(), n: ti.i32):
+        for k in range(self.table_size):
+            self.cell_count[k] = 0
+        for i in range(n):
+            k = self.slot(self.cell(points[i]))
+            self.point_slot[i] = k
+            ti.atomic_add(self.cell_count[k], 1)
+
+    @ti.kernel
+    def _scan(self):
+        for b in range(self.blocks):
+            total = 0
+            for k in range(b * self.block, (b + 1) * self.block):
+                self.cell_start[k] = total
+                total += self.cell_count[k]
+            self.block_sum[b] = total
+        for _ in range(1):  # serial, over one number per block
+            total = 0
+            for b in range(self.blocks):
+                count = self.block_sum[b]
+                self.block_sum[b] = total
+                total += count
+            self.cell_start[self.table_size] = total
+        for k in range(self.table_size):
+            self.cell_start[k] += self.block_sum[k // self.block]
+            self.cell_count[k] = 0  # fill counters of _scatter
+
+    @ti.kernel
+    def _scatter(self, n: ti.i32):
+        for i in range(n):
+            k = self.point_slot[i]
+            offset = ti.atomic_add(self.cell_count[k], 1)
+            self.entries[self.cell_start[k] + offset] = i
+
+    def build(self, points, n=None):
+        """Bin the first n (default: all) points of a vector field."""
+        n = self.capacity if n is None else n
+        self._count(points, n)
+        self._scan()
+        self._scatter(n)
@@ -0,0 +1,157 @@
+"""
+Parameter sweeps over the solver scripts on a process pool.
+
+Every combination of the --grid values is run headless by one of the
+worker processes. A worker runs its configurations one after another in
+the same interpreter, so Taichi is imported once per worker and each run
+only re-initializes the runtime. All reports are merged into one CSV:
+
+    python sweep.py 2_1_pbd_rod_jacobi.py 2_2_pbd_rod_jacobi.py \
+        --grid n=10,50,100 max-ite=10,100 --set frames=200 \
+        --workers 4 --out sweep.csv
+
+Grid keys are the scripts' own options without the leading dashes, so any
+option works (solver, n, N, max-ite, h, relax, ...); "on"/"off" toggle
+flags such as matrix-free. A configuration a script rejects is recorded
+with its error instead of stopping the sweep.
+
+Runs never share an output file: every run logs its residuals to its own
+file in --logs, and file options given with --set or --grid (profile,
+record, checkpoint, residual-log) get the run's number appended. The
+files a run opened are flushed and closed when it ends, see closing.py.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import runpy
+import sys
+import time
+
+import closing
+
+# options naming a file or directory a run writes
+OUTPUT_OPTIONS = ("residual-log", "profile", "record", "checkpoint")
+
+
+def parse_pairs(pairs, split):
+    options = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            raise SystemExit(f"expected key=value, got {pair!r}")
+        options[key] = value.split(",") if split else value
+    return options
+
+
+def command_line(options):
+    argv = []
+    for key, value in options.items():
+        if value == "on":
+            argv.append(f"--{key}")
+        elif value != "off":
+            argv += [f"--{key}", str(value)]
+    return argv
+
+
+def run_outputs(script, options, directory, index):
+    """Options with per-run output paths: residual logs in directory."""
+    stem = os.path.splitext(os.path.basename(script))[0]
+    options = {"residual-log": os.path.join(directory, stem + ".bin"),
+               **options}
+    for key in OUTPUT_OPTIONS:
+        if options.get(key) not in (None, "on", "off"):
+            root, ext = os.path.splitext(options[key])
+            options[key] = f"{root}-{index:04d}{ext}"
+    return options
+
+
+def init_worker(threads):
+    # one Taichi runtime per worker, sharing the cores with the others
+    os.environ["TI_CPU_MAX_NUM_THREADS"] = str(threads)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(script, options):
+    """Run one configuration headless in this process, return its report."""
+    sys.argv = [script] + command_line(options) + ["--headless", "--json"]
+    out, err = io.StringIO(), io.StringIO()
+    start = time.perf_counter()
+    error = None
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                runpy.run_path(script, run_name="__main__")
+            finally:
+                # pool workers never run atexit, close the run's files now
+                closing.close_all()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = str(e.code) if isinstance(e.code, str) else (
+                err.getvalue().strip().splitlines() or ["exit"])[-1]
+    except Exception as e:  # noqa: BLE001 - keep sweeping
+        error = f"{type(e).__name__}: {e}"
+    reports = [line for line in out.getvalue().splitlines()
+               if line.startswith("{")]
+    row = {"script": os.path.basename(script), **options,
+           "wall_s": time.perf_counter() - start}
+    if reports and error is None:
+        row.update(json.loads(reports[-1]))
+    else:
+        row["error"] = error or "no report"
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scripts", nargs="+")
+    parser.add_argument("--grid", nargs="+", default=[], metavar="KEY=V1,V2",
+                        help="option values to combine")
+    parser.add_argument("--set", nargs="+", default=[], metavar="KEY=V",
+                        help="options shared by every run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="sweep.csv")
+    parser.add_argument("--logs", metavar="DIR",
+                        help="residual logs of the runs (default: --out "
+                             "without its extension, plus _logs)")
+    args = parser.parse_args()
+    logs = args.logs or os.path.splitext(args.out)[0] + "_logs"
+
+    grid = parse_pairs(args.grid, split=True)
+    fixed = {"arch": "cpu", **parse_pairs(args.set, split=False)}
+    jobs = [(os.path.abspath(script), {**fixed, **dict(zip(grid, values))})
+            for script in args.scripts
+            for values in itertools.product(*grid.values())]
+    jobs = [(script, run_outputs(script, options, logs, k))
+            for k, (script, options) in enumerate(jobs)]
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    with concurrent.futures.ProcessPoolExecutor(
+            args.workers, initializer=init_worker,
+            initargs=(threads,)) as pool:
+        futures = [pool.submit(run, script, options)
+                   for script, options in jobs]
+        for k, future in enumerate(concurrent.futures.as_completed(futures)):
+            row = future.result()
+            status = row.get("error") or f"{row.get('seconds', 0):.3f}s"
+            print(f"[{k + 1}/{len(jobs)}] {row['script']} "
+                  + " ".join(f"{key}={row[key]}" for key in grid)
+                  + f" {status}", flush=True)
+    rows = [future.result() for future in futures]  # grid order
+
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    with open(args.out, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(rows)} runs, {sum('error' in row for row in rows)} failed, "
+          f"written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
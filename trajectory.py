@@ -0,0 +1,69 @@
+"""
+Trajectory recording for offline rendering.
+
+TrajectoryRecorder copies the particle positions of every frame into a
+preallocated memory-mapped array, so a simulation that is filmed pays for
+one copy into the page cache per frame instead of drawing and encoding a
+PNG. A trajectory is a directory
+
+    positions.npy   float32 (capacity, particles, 2), memory-mapped
+    edges.npy       int32 (edges, 2), the segments to draw
+    meta.json       frames recorded, time step and drawing style
+
+that render_trajectory.py turns into PNG frames on a process pool:
+
+    python 2_3_pbd_rod_fake_amgx.py --headless --frames 2000 --record traj
+    python render_trajectory.py traj --out video --workers 8
+"""
+import json
+import os
+
+import numpy as np
+
+import closing
+
+
+class TrajectoryRecorder:
+    def __init__(self, directory, capacity, particles, edges, h=None,
+                 **style):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.capacity = capacity
+        self.positions = np.lib.format.open_memmap(
+            os.path.join(directory, "positions.npy"), "w+", np.float32,
+            (capacity, particles, 2))
+        np.save(os.path.join(directory, "edges.npy"),
+                np.asarray(edges, np.int32))
+        self.meta = {"capacity": capacity, "h": h, "style": style}
+        self.count = 0
+        closing.register(self.close)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def record(self, positions):
+        """Append the positions of a field; False once full or closed."""
+        if self.full or self.positions is None:
+            return False
+        self.positions[self.count] = positions.to_numpy()
+        self.count += 1
+        return True
+
+    def close(self):
+        if self.positions is None:
+            return
+        self.positions.flush()
+        self.positions = None
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump({"frames": self.count, **self.meta}, f)
+
+
+def load_trajectory(directory):
+    """Return the recorded positions (memory-mapped), edges and meta."""
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    positions = np.load(os.path.join(directory, "positions.npy"),
+                        mmap_mode="r")
+    edges = np.load(os.path.join(directory, "edges.npy"))
+    return positions[:meta["frames"]], edges, meta